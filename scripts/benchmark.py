@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+import cv2
+import numpy as np
+from soilfauna.dataset import ImageData
+from soilfauna.export import CocoGenerator
+from soilfauna.image.process import KMeansLookup, apply_kmeans, convert_to_binary, find_prompt_points
+from soilfauna.segment import SegmentOptions, segment_image
+
+DEFAULT_OUTPUT = os.path.join(Path(__file__).parent.parent, 'out', 'benchmarks')
+
+parser = argparse.ArgumentParser(description='Times the preprocessing, tiling and export stages on synthetic images')
+
+parser.add_argument('-r', '--resolutions',
+                    nargs='+',
+                    type=int,
+                    default=[1024, 2048, 4096],
+                    help='Widths of the synthetic images, heights are 3/4 of them')
+
+parser.add_argument('-n', '--repeats',
+                    type=int,
+                    default=3,
+                    help='Runs of each stage, the fastest, median and mean times are kept')
+
+parser.add_argument('-o', '--out_dir',
+                    default=DEFAULT_OUTPUT,
+                    help='Directory of the JSON results')
+
+parser.add_argument('-b', '--baseline',
+                    help='Previous results file to compare with')
+
+parser.add_argument('--seed',
+                    type=int,
+                    default=0)
+
+
+def synthetic_image(width, height, seed=0, density=40):
+    """
+    BGR image looking like a sample: blue background with noise, light mineral
+    particles and brown to dark organisms (density per megapixel).
+    """
+    rng = np.random.default_rng(seed)
+
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (189, 130, 79)
+    image = cv2.add(image, rng.integers(0, 20, (height, width, 3), dtype=np.uint8))
+
+    count = max(1, int(density * width * height / 1e6))
+
+    for _ in range(count):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(8, 40)), int(rng.integers(4, 15)))
+        angle = int(rng.integers(0, 180))
+        color = (76, 107, 131) if rng.random() < 0.7 else (18, 28, 47)
+        cv2.ellipse(image, center, axes, angle, 0, 360, color, -1)
+
+    for _ in range(count // 2):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, center, int(rng.integers(2, 6)), (159, 173, 178), -1)
+
+    return image
+
+
+class StubTensor:
+    """
+    Minimal stand-in of the torch tensors read from SAM results.
+    """
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+    def any(self, axis):
+        return StubTensor(self.array.any(axis))
+
+    def __getitem__(self, key):
+        return StubTensor(self.array[key])
+
+
+class StubMasks:
+    def __init__(self, masks):
+        self.data = [StubTensor(mask) for mask in masks]
+
+
+class StubResult:
+    def __init__(self, masks):
+        self.masks = StubMasks(masks)
+
+
+class StubSAM:
+    """
+    Deterministic SAM replacement: every point prompt gives a full-size mask holding
+    a disk of the given radius around the point.
+    """
+    def __init__(self, radius=20):
+        self.radius = radius
+
+    def predict(self, image, points=None, **kwargs):
+        height, width = image.shape[:2]
+        masks = []
+
+        for x, y in points:
+            mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.circle(mask, (int(x), int(y)), self.radius, 1, -1)
+            masks.append(mask.astype(bool))
+
+        return [StubResult(masks)]
+
+
+def measure(function, repeats):
+    times = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def benchmark(width, height, directory, repeats, seed):
+    """
+    Returns the results of every stage for one resolution.
+    """
+    image = synthetic_image(width, height, seed)
+    path = os.path.join(directory, f'synthetic_{width}x{height}.jpg')
+    cv2.imwrite(path, image)
+
+    lookup = KMeansLookup.fit([image])
+    kmeans_image, foreground = apply_kmeans(image, lookup, return_mask=True)
+
+    data = ImageData(Path(path))
+    sam = StubSAM()
+
+    def load():
+        data.release()
+        return data.load(lookup)
+
+    def segment(segmentation):
+        options = SegmentOptions(segmentation=segmentation)
+        return segment_image(sam, data, options, kmeans=lookup)
+
+    def add_annotations(contours):
+        generator = CocoGenerator()
+        category_id = generator.add_category()
+        image_id = generator.add_image(image, 'synthetic.jpg')
+        for contour in contours:
+            generator.add_annotations(image_id, category_id, contour)
+        return generator
+
+    def add_annotations_batch(contours):
+        generator = CocoGenerator()
+        category_id = generator.add_category()
+        image_id = generator.add_image(image, 'synthetic.jpg')
+        generator.add_annotations_batch(image_id, category_id, contours)
+        return generator
+
+    load()
+    _, contours = segment('polygon')
+    generator = add_annotations_batch(contours)
+
+    stages = [
+        ('read_image', lambda: cv2.imread(path)),
+        ('apply_kmeans', lambda: apply_kmeans(image)),
+        ('apply_kmeans_lookup', lambda: apply_kmeans(image, lookup, return_mask=True)),
+        ('convert_to_binary', lambda: convert_to_binary(kmeans_image)),
+        ('find_prompt_points', lambda: find_prompt_points(foreground)),
+        ('image_load', load),
+        ('get_crops', data.get_crops),
+        ('segment_image_polygon', lambda: segment('polygon')),
+        ('segment_image_rle', lambda: segment('rle')),
+        ('add_annotations', lambda: add_annotations(contours)),
+        ('add_annotations_batch', lambda: add_annotations_batch(contours)),
+        ('coco_json', lambda: json.dumps(generator.generate())),
+    ]
+
+    results = []
+
+    for stage, function in stages:
+        # The full k-means fit is slow on large images, it is only run once
+        times = measure(function, 1 if stage == 'apply_kmeans' else repeats)
+
+        results.append({
+            'stage': stage,
+            'width': width,
+            'height': height,
+            'repeats': len(times),
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'megapixels_per_second': width * height / 1e6 / min(times),
+            'annotations': len(contours)
+        })
+
+        print(f'{width}x{height} {stage:<24} {min(times) * 1000:10.2f} ms')
+
+    data.release()
+
+    return results
+
+
+def compare(results, baseline_path):
+    """
+    Prints the speedup of every stage against a previous results file (> 1 is faster).
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+
+    previous = {(result['stage'], result['width'], result['height']): result['min'] for result in baseline['results']}
+
+    print(f'\nCompared to {baseline_path}')
+
+    for result in results:
+        key = (result['stage'], result['width'], result['height'])
+        if key in previous:
+            print(f'{result["width"]}x{result["height"]} {result["stage"]:<24} {previous[key] / result["min"]:6.2f}x')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for width in args.resolutions:
+            results.extend(benchmark(width, width * 3 // 4, directory, args.repeats, args.seed))
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'repeats': args.repeats,
+        'seed': args.seed,
+        'results': results
+    }
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    output = os.path.join(args.out_dir, f'benchmark-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=4)
+
+    print(f'\nResults written to {output}')
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -1,19 +1,24 @@
 import argparse
+import io
 import json
 from pathlib import Path
 import os
-import pandas as pd
-from soilfauna.biigle import BiigleAPI
+import polars as pl
+from soilfauna.biigle import BiigleAPI, LabelTreeCache
+from soilfauna.export import CocoReader
+from soilfauna.export.merge import read_categories
 from dotenv import load_dotenv
 import zipfile
 from datetime import datetime
 import shutil
+import tempfile
 import glob
 
 load_dotenv()
 
 
 DEFAULT_OUTPUT = os.path.join(Path(__file__).parent.parent, 'out', 'biigle')
+DEFAULT_CACHE = os.path.join(Path(__file__).parent.parent, 'out', 'biigle', 'cache')
 BIIGLE_BASE_FILES = os.path.join(Path(__file__).parent.parent, 'soilfauna', 'biigle', 'data')
 
 parser = argparse.ArgumentParser()
@@ -33,29 +38,181 @@ parser.add_argument("-v", "--volume_name",
                     default='volume01',
                     help="""Volume name""")
 
-parser.add_argument('-t', '--label_tree_name')
+parser.add_argument('-t', '--label_tree_name',
+                    required=True,
+                    help="""Name of the BIIGLE label tree of the annotations""")
+
+parser.add_argument('--cache_dir',
+                    default=DEFAULT_CACHE,
+                    help="""Directory of the downloaded label trees""")
+
+parser.add_argument('--refresh_label_tree',
+                    action='store_true',
+                    help="""Download the label tree even if it is cached""")
+
+parser.add_argument('--label_tree_max_age',
+                    type=float,
+                    default=24,
+                    help="""Hours after which a cached label tree without version is downloaded again""")
+
+parser.add_argument('--chunk_size',
+                    type=int,
+                    default=100000,
+                    help="""Annotations converted and written at once""")
+
+
+def write_chunk(frame, file, first, quote_style='non_numeric'):
+    # Rendered to a string first, polars does not write to every kind of file object
+    file.write(frame.write_csv(include_header=first, quote_style=quote_style))
+
+LABEL_COLUMNS = ['annotation_id', 'label_id', 'user_id', 'confidence', 'created_at', 'updated_at']
+ANNOTATION_COLUMNS = ['id', 'image_id', 'shape_id', 'created_at', 'updated_at', 'points']
+
+def format_points(segmentation):
+    """
+    Flattens the polygons of an annotation to one list of coordinates, each formatted
+    as Python does, so integer and float coordinates keep their own form.
+    """
+    return '[' + ', '.join(str(value) for polygon in segmentation for value in polygon) + ']'
+
+def annotations_frame(chunk, start, category_labels, user_id, now):
+    """
+    Builds the rows of a chunk of (image_id, category_id, points) annotations,
+    numbered from start.
+    """
+    image_ids, category_ids, points = zip(*chunk)
+
+    frame = pl.DataFrame({'image_id': image_ids, 'category_id': category_ids, 'points': points})
+
+    return frame.with_columns(
+        annotation_id=pl.int_range(start, start + pl.len()),
+        label_id=pl.col('category_id').replace_strict(category_labels, default=None, return_dtype=pl.Int64),
+        user_id=pl.lit(user_id),
+        confidence=pl.lit(1),
+        created_at=pl.lit(now),
+        updated_at=pl.lit(now),
+        shape_id=pl.lit(3)
+    )
+
+def coco2biigle(coco_file, labels_file, annotations_file, images_file, labels_map, user_id, now, chunk_size=100000):
+    """
+    Streams the annotations of a COCO file to the image_annotation_labels.csv, image_annotations.csv
+    and images.csv text files given, chunk_size annotations at a time. images.csv is written last.
+    Returns the number of annotations written and the category names missing from labels_map.
+    """
+    category_labels = {}
+    missing = set()
+    images = {}
+    annotated_images = {}
+
+    def add_categories(categories):
+        for category in categories:
+            name = category['name'].strip()
+            category_labels[category['id']] = labels_map.get(name)
+
+            if name not in labels_map:
+                missing.add(name)
+
+    count = 0
+    skipped = 0
+    chunk = []
+
+    def flush():
+        frame = annotations_frame(chunk, count - len(chunk) + 1, category_labels, user_id, now)
+
+        write_chunk(frame.select(LABEL_COLUMNS), labels_file, False)
+        write_chunk(frame.rename({'annotation_id': 'id'}).select(ANNOTATION_COLUMNS), annotations_file, False)
+
+        for image_id in frame['image_id'].unique(maintain_order=True).to_list():
+            annotated_images.setdefault(image_id, None)
+
+        chunk.clear()
+
+    # Headers are written up front, for files without annotations too
+    write_chunk(pl.DataFrame(schema=LABEL_COLUMNS), labels_file, True)
+    write_chunk(pl.DataFrame(schema=ANNOTATION_COLUMNS), annotations_file, True)
+
+    read_ahead = False
+
+    for key, item in CocoReader(coco_file):
+        if key == 'images':
+            images[item['id']] = item['file_name']
+        elif key == 'categories' and not read_ahead:
+            add_categories([item])
+        elif key == 'annotations':
+            if not category_labels:
+                # Categories are written after the annotations in this file
+                add_categories(read_categories(coco_file))
+                read_ahead = True
+
+            if not isinstance(item['segmentation'], list):
+                # RLE masks have no points
+                skipped += 1
+                continue
+
+            chunk.append((item['image_id'], item['category_id'], format_points(item['segmentation'])))
+            count += 1
+
+            if len(chunk) == chunk_size:
+                flush()
+
+    if chunk:
+        flush()
+
+    if skipped:
+        print(f'{skipped} RLE annotations skipped, BIIGLE only takes polygons')
+
+    images_frame = pl.DataFrame({
+        'id': list(annotated_images),
+        'filename': [images.get(image_id) for image_id in annotated_images],  # Needs to be updated with biigle image id
+        'volume_id': 1  # Need to be fixed ?
+    })
+    write_chunk(images_frame, images_file, True, quote_style='necessary')
+
+    return count, missing
+
+
+def zip_text(archive, name):
+    """
+    Opens a text file written straight into the archive.
+    """
+    return io.TextIOWrapper(archive.open(name, 'w', force_zip64=True), encoding='utf-8', newline='')
+
+def write_archive(archive_path, coco_file, label_tree_files, volume, chunk_size=100000):
+    """
+    Writes the BIIGLE import archive in one pass over the COCO file. label_tree_files are the
+    JSON files of the label tree export, as {name: bytes}. Returns the number of annotations
+    written and the category names without a label in the label tree.
+    """
+    label_tree = json.loads(label_tree_files['label_trees.json'])
+    users = json.loads(label_tree_files['users.json'])
+
+    labels = label_tree[0].get('labels')
+    labels_map = {label['name']: label['id'] for label in labels}
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive, \
+            tempfile.SpooledTemporaryFile(max_size=64 << 20, mode='w+', encoding='utf-8', newline='') as labels_file, \
+            tempfile.SpooledTemporaryFile(max_size=64 << 20, mode='w+', encoding='utf-8', newline='') as images_file:
+        # A zip entry is written at a time, the smaller CSVs wait in memory (or on disk once large)
+        with zip_text(archive, 'image_annotations.csv') as annotations_file:
+            count, missing = coco2biigle(coco_file, labels_file, annotations_file, images_file, labels_map, users[0]['id'], now, chunk_size)
 
+        for name, file in (('image_annotation_labels.csv', labels_file), ('images.csv', images_file)):
+            file.seek(0)
+            with zip_text(archive, name) as entry:
+                shutil.copyfileobj(file, entry)
 
-def merge_list(x):
-        res = list()
-        for i in x:
-            res.extend(i)
-        return res
+        archive.writestr('volumes.json', json.dumps(volume))
 
-def coco2df(coco):
-    '''
-    Fit a coco instance into a flat pandas DataFrame.
-    '''
-    classes_df = pd.DataFrame(coco['categories'])
-    classes_df['name'] = classes_df['name'].str.strip()
-    classes_df = classes_df.rename(columns={"id": "category_id"})
-    images_df = pd.DataFrame(coco['images'])
-    images_df.rename(columns={"id": "image_id"}, inplace=True)
-    coco_df = pd.DataFrame(coco['annotations'])\
-                    .merge(classes_df, on="category_id", how='left')\
-                    .merge(images_df, on="image_id", how='left')
+        for name, content in label_tree_files.items():
+            archive.writestr(name, content)
 
-    return coco_df
+        for path in sorted(glob.glob(os.path.join(BIIGLE_BASE_FILES, '*'))):
+            archive.write(path, os.path.basename(path))
+
+    return count, missing
 
 
 if __name__ == '__main__':
@@ -67,104 +224,16 @@ if __name__ == '__main__':
     volume_name = args.volume_name
     label_tree_name = args.label_tree_name
 
-    with open(coco_file, 'r') as f:
-        coco = json.load(f)
-
-    output_path = os.path.join(output_dir, project_name, volume_name)
-    temp_path = os.path.join(output_dir, 'temp')
-    Path(output_path).mkdir(parents=True, exist_ok=True)
-    Path(temp_path).mkdir(parents=True, exist_ok=True)
-
-    df = coco2df(coco)
-
-    df['annotation_id'] = df.index + 1
+    Path(output_dir, project_name).mkdir(parents=True, exist_ok=True)
 
     api = BiigleAPI()
-    label_tree_file = api.download_label_tree(temp_path)
-    
-    with zipfile.ZipFile('/Users/robin/DEV/soil-fauna-ai/out/biigle/temp/label-tree.zip', 'r') as zip:
-        zip.extractall(temp_path)
+    label_tree = api.find_label_tree(label_tree_name)
 
-    label_tree_path = os.path.join(temp_path, 'label_trees.json')
-    user_path = os.path.join(temp_path, 'users.json')
+    if label_tree is None:
+        raise ValueError(f'Label tree {label_tree_name} not found')
 
-    with open(label_tree_path, 'r') as f:
-        label_tree = json.load(f)
-
-    labels = label_tree[0].get('labels')
-
-    labels_map = {label['name']: label['id'] for label in labels}
-
-    df['label_id'] = df['name'].map(labels_map)
-
-    with open(user_path, 'r') as f:
-        users = json.load(f)
-
-    df['user_id'] = users[0]['id']
-    df['confidence'] = 1
-
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-    df['created_at'] = now
-    df['updated_at'] = now
-
-    image_annotation_labels_cols = [
-        'annotation_id',
-        'label_id', 
-        'user_id',
-        'confidence',
-        'created_at',
-        'updated_at'
-    ]
-
-    # Dump image_annotation_labels.csv
-    df[image_annotation_labels_cols].to_csv(
-        os.path.join(output_path, "image_annotation_labels.csv"),
-        sep=",",
-        index=False,
-        quotechar='"',
-        quoting=2
-    )
-
-    # Dump image_annotations.csv
-    df['id'] = df['annotation_id']
-    df['shape_id'] = 3
-
-    df['points'] = df['segmentation'].apply(merge_list)
-
-    select_col = [
-        'id',
-        'image_id', 
-        'shape_id',
-        'created_at',
-        'updated_at',
-        'points'
-    ]
-
-    df[select_col].to_csv(
-        os.path.join(output_path, "image_annotations.csv"),
-        sep=",",
-        index=False,
-        quotechar='"',
-        quoting=2
-    )
-
-    # Preparing image.csv
-    df['id'] = df['image_id']
-    df['filename'] = df['file_name']  # Needs to be updated with biigle image id
-    df['volume_id'] = 1  # Need to be fixed ?
-
-    select_col = [
-        'id',
-        'filename',
-        'volume_id'
-    ]
-
-    df[select_col].drop_duplicates(keep='first').to_csv(
-        os.path.join(output_path, "images.csv"),
-        sep=",",
-        index=False
-    )
+    cache = LabelTreeCache(args.cache_dir, max_age=args.label_tree_max_age * 3600)
+    label_tree_zip = cache.get(api, label_tree['id'], label_tree.get('version_id'), refresh=args.refresh_label_tree)
 
     volume = [{
         "id": 1,
@@ -174,22 +243,16 @@ if __name__ == '__main__':
         "media_type_name": "image"
     }]
 
-    with open(os.path.join(output_path, 'volumes.json'), "w") as js:
-        json.dump(volume, js)
-
-    for z in glob.glob(os.path.join(BIIGLE_BASE_FILES, '*')):
-        print(z)
-        shutil.copy(z, os.path.join(output_path, os.path.basename(z)))
-
-    for z in glob.glob(os.path.join(temp_path, '*.json')):
-        print(z)
-        shutil.copy(z, os.path.join(output_path, os.path.basename(z)))
-
-    to_compress = [f for f in glob.glob(os.path.join(output_path, '*'))]
-
-    with zipfile.ZipFile(f"{os.path.join(output_path)}.zip", "w") as archive:
-        for file in to_compress:
-            archive.write(file, os.path.basename(file))
+    archive_path = f'{os.path.join(output_dir, project_name, volume_name)}.zip'
+    count, missing = write_archive(archive_path, coco_file, cache.read(label_tree_zip), volume, args.chunk_size)
 
+    if missing and label_tree_zip not in cache.downloaded:
+        # Labels may have been added to the label tree since it was cached
+        print(f'Labels {", ".join(sorted(missing))} not in the cached label tree, downloading it again')
+        label_tree_zip = cache.get(api, label_tree['id'], label_tree.get('version_id'), refresh=True)
+        count, missing = write_archive(archive_path, coco_file, cache.read(label_tree_zip), volume, args.chunk_size)
 
+    if missing:
+        print(f'Warning: labels {", ".join(sorted(missing))} not in label tree {label_tree_name}, their label_id is empty')
 
+    print(f'{count} annotations written to {archive_path}')
@@ -1,7 +1,20 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import errno
+import hashlib
 import os
 import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl cloning a file on Linux filesystems with reflinks (Btrfs, XFS, ...)
+FICLONE = 0x40049409
 
 parser = argparse.ArgumentParser()
 
@@ -26,6 +39,116 @@ parser.add_argument(
     action='store_true',
 )
 
+parser.add_argument(
+    '-l',
+    '--link',
+    help='Hardlink or reflink files instead of copying them, for staging on the same filesystem. '
+         'reflink falls back to a copy where it is not supported',
+    choices=['hardlink', 'reflink'],
+)
+
+parser.add_argument(
+    '-w',
+    '--workers',
+    help='Files copied in parallel',
+    type=int,
+    default=8,
+)
+
+parser.add_argument(
+    '-c',
+    '--checksum',
+    help='Compare files by content hash instead of size and modification time to skip unchanged ones',
+    action='store_true',
+)
+
+def file_hash(path):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def unchanged(source, target, checksum=False):
+    """
+    Whether target already holds source: same file, or same size and mtime (or content with checksum).
+    """
+    try:
+        target_stat = os.stat(target)
+    except FileNotFoundError:
+        return False
+
+    source_stat = os.stat(source)
+
+    if os.path.samestat(source_stat, target_stat):
+        return True
+
+    if source_stat.st_size != target_stat.st_size:
+        return False
+
+    if checksum:
+        return file_hash(source) == file_hash(target)
+
+    return int(source_stat.st_mtime) == int(target_stat.st_mtime)
+
+warned = set()
+warned_lock = threading.Lock()
+
+def warn_once(message):
+    with warned_lock:
+        if message not in warned:
+            warned.add(message)
+            print(f'Warning: {message}')
+
+def reflink(source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, target)
+
+def transfer(source, target, move=False, link=None, checksum=False):
+    """
+    Copies, moves or links source to target. Returns the bytes transferred, None when skipped.
+    """
+    if unchanged(source, target, checksum):
+        if move and os.path.abspath(source) != os.path.abspath(target):
+            # The source is only deleted once the target is known to hold it, not on size and mtime alone
+            if checksum or os.path.samefile(source, target) or file_hash(source) == file_hash(target):
+                os.remove(source)
+            else:
+                print(f'{source} kept: {target} has the same size and modification time but a different content')
+        return None
+
+    size = os.path.getsize(source)
+
+    if move:
+        shutil.move(source, target)
+        return size
+
+    # Written next to the target and renamed, an interrupted copy never looks complete
+    partial = target.with_name(f'.{target.name}.part')
+
+    if link == 'hardlink':
+        if os.path.exists(partial):
+            os.remove(partial)
+        try:
+            os.link(source, partial)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            warn_once(f'{target.parent} is not on the filesystem of the sources, copying instead of hardlinking')
+            shutil.copy2(source, partial)
+    elif link == 'reflink' and fcntl:
+        try:
+            reflink(source, partial)
+        except OSError:
+            shutil.copy2(source, partial)
+    else:
+        shutil.copy2(source, partial)
+
+    os.replace(partial, target)
+
+    return size
+
 if __name__ == '__main__':
     args = parser.parse_args()
     
@@ -60,7 +183,45 @@ if __name__ == '__main__':
             print('Aborting.')
             exit(0)
 
-    action = shutil.move if move else shutil.copy
+    # Files are flattened into the destination, only the first file of a name is kept
+    targets = {}
+    collisions = 0
 
     for file in files_to_move:
-        action(file, destination)
\ No newline at end of file
+        if file.name in targets:
+            collisions += 1
+            print(f'Name collision: {file} skipped, {targets[file.name]} has the same name')
+            continue
+        targets[file.name] = file
+
+    start = time.perf_counter()
+    transferred = 0
+    total_bytes = 0
+    skipped = 0
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(transfer, file, destination / name, move, args.link, args.checksum)
+            for name, file in targets.items()
+        ]
+
+        for i, future in enumerate(futures, start=1):
+            size = future.result()
+
+            if size is None:
+                skipped += 1
+            else:
+                transferred += 1
+                total_bytes += size
+
+            if i % 1000 == 0:
+                print(f'{i}/{len(futures)} files')
+
+    elapsed = time.perf_counter() - start
+    action = 'moved' if move else args.link + 'ed' if args.link else 'copied'
+
+    print(
+        f'{transferred} files {action} ({total_bytes / 2**20:.1f} MiB), {skipped} unchanged skipped, '
+        f'{collisions} name collisions in {elapsed:.1f}s: '
+        f'{transferred / elapsed if elapsed else 0:.1f} files/s, {total_bytes / 2**20 / elapsed if elapsed else 0:.1f} MiB/s'
+    )
\ No newline at end of file
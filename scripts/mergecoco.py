@@ -0,0 +1,36 @@
+import argparse
+from pathlib import Path
+import os
+from soilfauna.export import merge_coco
+
+parser = argparse.ArgumentParser(description='Merges COCO files, e.g. the outputs of a dataset segmented in shards')
+
+parser.add_argument('inputs',
+                    nargs='+',
+                    help='COCO files merged into one, or output folders of the shards whose files of the same name are merged')
+
+parser.add_argument('-o', '--output',
+                    required=True,
+                    help='Merged COCO file, or folder of the merged files when the inputs are folders')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    inputs = [Path(path) for path in args.inputs]
+
+    if all(path.is_dir() for path in inputs):
+        groups = {}
+        for directory in inputs:
+            for file in sorted(directory.glob('*-annotations.json')):
+                groups.setdefault(file.name, []).append(file)
+
+        os.makedirs(args.output, exist_ok=True)
+        outputs = [(files, os.path.join(args.output, name)) for name, files in groups.items()]
+    elif any(path.is_dir() for path in inputs):
+        raise ValueError('Inputs must be all files or all folders')
+    else:
+        outputs = [(inputs, args.output)]
+
+    for files, output in outputs:
+        images, annotations = merge_coco(files, output)
+        print(f'{output}: {len(files)} files, {images} images, {annotations} annotations')
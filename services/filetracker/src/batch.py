@@ -0,0 +1,158 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def is_retryable(error, idempotent=True):
+    """
+    Quota and server errors (HttpError carries the response status in resp.status) and network errors.
+
+    A request that is not idempotent is only retried when it was certainly not applied: rejected
+    by the quota (429), or never sent as the connection was refused. A timeout or a server error
+    may come after the request was applied.
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+
+    if status is not None:
+        return int(status) in (RETRY_STATUSES if idempotent else (429,))
+
+    if not idempotent:
+        return isinstance(error, ConnectionRefusedError)
+
+    # Connection errors and timeouts
+    return isinstance(error, OSError)
+
+def chunks(items, max_rows, max_bytes, size=lambda item: len(json.dumps(item))):
+    """
+    Splits items in chunks of at most max_rows items and about max_bytes of JSON.
+    """
+    chunk = []
+    chunk_bytes = 0
+
+    for item in items:
+        item_bytes = size(item)
+
+        if chunk and (len(chunk) >= max_rows or chunk_bytes + item_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(item)
+        chunk_bytes += item_bytes
+
+    if chunk:
+        yield chunk
+
+class RateLimiter:
+    """
+    Spaces requests to at most requests_per_minute, across threads.
+    """
+    def __init__(self, requests_per_minute):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+class BatchWriter:
+    """
+    Writes rows to the Sheets values API in size-bounded chunks, with bounded concurrency,
+    a request rate limit and exponential backoff on quota and server errors.
+
+    values_factory returns a `spreadsheets().values()` resource. It is called once per thread,
+    as the Google API client is not thread-safe.
+    """
+    def __init__(self, values_factory, spreadsheet_id, max_rows=500, max_bytes=1 << 20, concurrency=4,
+                 requests_per_minute=50, retries=6, backoff=1.0, max_backoff=64.0):
+        self.values_factory = values_factory
+        self.spreadsheet_id = spreadsheet_id
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.limiter = RateLimiter(requests_per_minute)
+        self.local = threading.local()
+
+    def values(self):
+        if not hasattr(self.local, 'values'):
+            self.local.values = self.values_factory()
+        return self.local.values
+
+    def execute(self, request, idempotent=True):
+        """
+        Runs request(values) until it succeeds, sleeping backoff * 2^attempt (with jitter) between attempts.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+
+            try:
+                return request(self.values()).execute()
+            except Exception as error:
+                if attempt == self.retries or not is_retryable(error, idempotent):
+                    raise
+
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1))
+
+    def run(self, label, chunked, request, idempotent=True, concurrency=None):
+        """
+        Sends every chunk with request(values, chunk), reporting progress in rows. Chunks are
+        sent by up to concurrency threads (the writer's by default), so in no particular order.
+        """
+        chunked = list(chunked)
+        total = sum(len(chunk) for chunk in chunked)
+        done = 0
+
+        if not total:
+            return
+
+        with ThreadPoolExecutor(max_workers=concurrency or self.concurrency) as executor:
+            futures = {executor.submit(self.execute, lambda values, chunk=chunk: request(values, chunk), idempotent): len(chunk) for chunk in chunked}
+
+            for future in as_completed(futures):
+                future.result()
+                done += futures[future]
+                print(f'{label}: {done}/{total} rows')
+
+    def append(self, range, rows):
+        """
+        Appends rows (lists of cell values) after the table in range. Appending twice would
+        duplicate the rows, so only failures where nothing was appended are retried.
+
+        Chunks are appended one at a time: each one lands after the table as it is when the
+        request runs, so concurrent appends would reorder the rows or race for the same range.
+        """
+        def request(values, chunk):
+            return values.append(
+                spreadsheetId=self.spreadsheet_id,
+                range=range,
+                valueInputOption='USER_ENTERED',
+                body={'values': chunk}
+            )
+
+        self.run('Inserted', chunks(rows, self.max_rows, self.max_bytes), request, idempotent=False, concurrency=1)
+
+    def batch_update(self, data):
+        """
+        Writes {'range': ..., 'values': ...} entries with batchUpdate calls.
+        """
+        def request(values, chunk):
+            return values.batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'valueInputOption': 'USER_ENTERED', 'data': chunk}
+            )
+
+        self.run('Updated', chunks(data, self.max_rows, self.max_bytes), request)
@@ -1,11 +1,16 @@
+import argparse
 import os
 import re
+import time
 from dotenv import load_dotenv
 from pathlib import Path
 
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 
+from batch import BatchWriter
+from state import ScanState
+
 load_dotenv()
 
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
@@ -15,6 +20,22 @@ FILENAME_REGEX = r'(?P<batch>[\da-zA-Z-_]*)_(?P<position>r\d{1,2}c\d{1,2}).(?P<e
 
 ALL_IMAGES_FOLDER = os.getenv('ALL_IMAGES_FOLDER')
 SELECTED_IMAGES_FOLDER = os.getenv('SELECTED_IMAGES_FOLDER')
+STATE_FILE = os.getenv('FILETRACKER_STATE', os.path.join(Path(__file__).parent, 'state.sqlite'))
+
+parser = argparse.ArgumentParser(description='Tracks the stored and selected images in the tracking sheet')
+
+parser.add_argument('--state',
+                    default=STATE_FILE,
+                    help='SQLite file of the scanned folders, only modified directories are listed again. Empty for a full walk')
+
+parser.add_argument('--watch',
+                    action='store_true',
+                    help='Keep running and sync new files as they land')
+
+parser.add_argument('--interval',
+                    type=float,
+                    default=30,
+                    help='Seconds between checks in watch mode')
 
 class ImageFile:
     def __init__(self, index=0, filename=None, batch=None, stored=False, selected=False, tracked=False):
@@ -60,70 +81,38 @@ def build_service():
 
     return service
             
-def list_files(path):
+def list_files(path, state=None):
     """
-    List files matching FILENAME_REGEX in path and subdirs
+    List files matching FILENAME_REGEX in path and subdirs, as {filename: batch}.
+    With a ScanState, only the directories modified since the last run are listed.
     """
-    result = []
+    if state:
+        files, _ = state.scan(path)
+        return files
+
+    result = {}
     for _, _, files in os.walk(path):
-        result.extend(
-            files
-        )
+        for filename in files:
+            match = re.match(FILENAME_REGEX, filename)
+            if match:
+                result[filename] = match.group('batch')
     return result
     
-def build_local_list(all_images_path, selected_images_path):
-    all_images = set(list_files(all_images_path))
-    selected_images = set(list_files(selected_images_path))
-    
-    in_both = all_images & selected_images
-    only_stored = all_images - selected_images
-    only_selected = selected_images - all_images
-    
-    all = []
-    
-    for img in in_both:
-        match = re.match(FILENAME_REGEX, img)
-        if match:
-            all.append(
-                ImageFile(
-                    index=0,
-                    filename=img,
-                    batch=match.group('batch'),
-                    stored=True,
-                    selected=True,
-                    tracked=False
-                )
-            )
-        
-    for img in only_stored:
-        match = re.match(FILENAME_REGEX, img)
-        if match:
-            all.append(
-                ImageFile(
-                    index=0,
-                    filename=img,
-                    batch=match.group('batch'),
-                    stored=True,
-                    selected=False,
-                    tracked=False
-                )
-            )
-        
-    for img in only_selected:
-        match = re.match(FILENAME_REGEX, img)
-        if match:
-            all.append(
-                ImageFile(
-                    index=0,
-                    filename=img,
-                    batch=match.group('batch'),
-                    stored=False,
-                    selected=True,
-                    tracked=False
-                )
-            )
-    
-    return all
+def build_local_list(all_images_path, selected_images_path, state=None):
+    all_images = list_files(all_images_path, state)
+    selected_images = list_files(selected_images_path, state)
+
+    return [
+        ImageFile(
+            index=0,
+            filename=filename,
+            batch=batch,
+            stored=filename in all_images,
+            selected=filename in selected_images,
+            tracked=False
+        )
+        for filename, batch in {**selected_images, **all_images}.items()
+    ]
 
 def parse_bool(value):
     truth = ['TRUE']
@@ -156,68 +145,83 @@ def build_remote_list(service):
     return files
 
 def compare(tracked, local):
+    """
+    Returns the local files missing from the sheet, and the tracked files whose
+    stored/selected state changed. Tracked files are indexed by filename.
+    """
+    tracked_by_name = {f.filename: f for f in tracked}
+
     to_update = []
     to_insert = []
     for f in local:
-        if f in tracked:
-            f.index = tracked[tracked.index(f)].index
-            f.tracked = True
-            to_update.append(f)
-        else:
+        remote = tracked_by_name.get(f.filename)
+
+        if remote is None:
             to_insert.append(f)
-    
-    return to_insert, to_update
+            continue
 
-def insert_files(service, values):
-    values = [
-        f.to_list() for f in values
-    ]
-    
-    body = {
-        'values': values
-    }
-    
-    result = (
-        service.spreadsheets()
-        .values()
-        .append(
-            spreadsheetId=SPREADSHEET_ID,
-            range='tracking!A2:E',
-            valueInputOption="USER_ENTERED",
-            body=body
-        )
-        .execute()
-    )
+        f.index = remote.index
+        f.tracked = True
 
-def update_files(service, values):
-    data = []
-    
-    for f in values:
-        data.append(
-            {
-                'range': f'tracking!A{f.index}:E{f.index}',
-                'values': [f.to_list()]
-            }
-        )
-    body = {
-        'valueInputOption': 'USER_ENTERED',
-        'data': data
-    }
+        if (f.stored, f.selected) != (remote.stored, remote.selected):
+            to_update.append(f)
     
-    result = (
-        service.spreadsheets()
-        .values()
-        .batchUpdate(spreadsheetId=SPREADSHEET_ID, body=body)
-        .execute()
-    )
+    return to_insert, to_update
+
+def insert_files(writer, values):
+    writer.append('tracking!A2:E', [f.to_list() for f in values])
+
+def update_files(writer, values):
+    writer.batch_update([
+        {
+            'range': f'tracking!A{f.index}:E{f.index}',
+            'values': [f.to_list()]
+        }
+        for f in values
+    ])
  
-if __name__ == '__main__':
-    service = build_service()
-    
-    images = build_local_list(all_images_path=ALL_IMAGES_FOLDER, selected_images_path=SELECTED_IMAGES_FOLDER)
+def sync(service, writer, state=None):
+    images = build_local_list(all_images_path=ALL_IMAGES_FOLDER, selected_images_path=SELECTED_IMAGES_FOLDER, state=state)
     remote = build_remote_list(service)
     
     to_insert, to_update = compare(remote, images)
-    
-    insert_files(service=service, values=to_insert)
-    update_files(service=service, values=to_update)
\ No newline at end of file
+    print(f'{len(to_insert)} files to insert, {len(to_update)} to update')
+
+    insert_files(writer=writer, values=to_insert)
+    update_files(writer=writer, values=to_update)
+
+def watch(service, writer, state, interval=30):
+    """
+    Syncs whenever a scan of the image folders finds changes, checking every interval seconds.
+    Only directory mtimes are checked between changes, there is no full walk.
+    """
+    sync(service, writer, state)
+
+    while True:
+        time.sleep(interval)
+
+        changed = False
+        for folder in (ALL_IMAGES_FOLDER, SELECTED_IMAGES_FOLDER):
+            _, folder_changed = state.scan(folder)
+            changed = changed or folder_changed
+
+        if changed:
+            sync(service, writer, state)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    service = build_service()
+    writer = BatchWriter(lambda: build_service().spreadsheets().values(), SPREADSHEET_ID)
+    state = ScanState(args.state, FILENAME_REGEX) if args.state else None
+
+    try:
+        if args.watch:
+            if not state:
+                parser.error('--watch needs a state file')
+            watch(service, writer, state, args.interval)
+        else:
+            sync(service, writer, state)
+    finally:
+        if state:
+            state.close()
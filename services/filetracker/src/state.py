@@ -0,0 +1,101 @@
+import os
+import re
+import sqlite3
+
+class ScanState:
+    """
+    Persistent SQLite state of the scanned folders: directory mtimes and the matching files of each.
+
+    A directory is only listed again when its mtime changed since the last scan, unchanged
+    directories only cost a stat, so rescanning a large tree on network storage is fast.
+    """
+    def __init__(self, path, filename_regex):
+        self.path = path
+        self.filename_regex = re.compile(filename_regex)
+        self.connection = sqlite3.connect(path)
+        self.create_tables()
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    root TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    parent TEXT,
+                    mtime INTEGER NOT NULL,
+                    PRIMARY KEY (root, path)
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    directory TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    batch TEXT NOT NULL,
+                    PRIMARY KEY (directory, name)
+                );
+                CREATE INDEX IF NOT EXISTS directories_parent ON directories (root, parent);
+            ''')
+
+    def scan(self, root):
+        """
+        Updates the state of root. Returns its matching files as {filename: batch},
+        and whether anything changed since the last scan.
+        """
+        root = os.path.abspath(root)
+        cursor = self.connection.cursor()
+        seen = set()
+        changed = False
+        stack = [(root, None)]
+
+        while stack:
+            directory, parent = stack.pop()
+            mtime = os.stat(directory).st_mtime_ns
+            seen.add(directory)
+
+            known = cursor.execute('SELECT mtime FROM directories WHERE root = ? AND path = ?', (root, directory)).fetchone()
+
+            if known and known[0] == mtime:
+                children = cursor.execute('SELECT path FROM directories WHERE root = ? AND parent = ?', (root, directory)).fetchall()
+                stack.extend((child, directory) for (child,) in children)
+                continue
+
+            changed = True
+            files = []
+
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, directory))
+                        continue
+
+                    match = self.filename_regex.match(entry.name)
+                    if match:
+                        files.append((directory, entry.name, match.group('batch')))
+
+            cursor.execute('DELETE FROM files WHERE directory = ?', (directory,))
+            cursor.executemany('INSERT OR REPLACE INTO files (directory, name, batch) VALUES (?, ?, ?)', files)
+            cursor.execute(
+                'INSERT OR REPLACE INTO directories (path, root, parent, mtime) VALUES (?, ?, ?, ?)',
+                (directory, root, parent, mtime)
+            )
+
+        # Directories removed since the last scan
+        removed = [
+            (root, path) for (path,) in cursor.execute('SELECT path FROM directories WHERE root = ?', (root,)).fetchall()
+            if path not in seen
+        ]
+
+        if removed:
+            changed = True
+            cursor.executemany('DELETE FROM directories WHERE root = ? AND path = ?', removed)
+            cursor.executemany('DELETE FROM files WHERE directory = ?', [(path,) for _, path in removed])
+
+        self.connection.commit()
+
+        files = cursor.execute(
+            'SELECT files.name, files.batch FROM files JOIN directories ON files.directory = directories.path WHERE directories.root = ?',
+            (root,)
+        ).fetchall()
+
+        return dict(files), changed
+
+    def close(self):
+        self.connection.close()
@@ -1 +1,2 @@
-from .api import BiigleAPI
\ No newline at end of file
+from .api import BiigleAPI
+from .cache import LabelTreeCache
\ No newline at end of file
@@ -1,7 +1,10 @@
 from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import os
+import time
 
 load_dotenv()
 
@@ -10,49 +13,114 @@ API_BASE_URL = os.getenv('BIIGLE_API_BASE_URL')
 class BiigleAPI:
     """
     Biigle API requester
+
+    Connections are pooled and failed requests (connection errors, 429 and 5xx responses)
+    are retried with exponential backoff. Metadata responses are cached for cache_ttl seconds,
+    downloads are streamed to disk in chunks.
     """
-    def __init__(self, server_url=API_BASE_URL):
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, server_url=API_BASE_URL, user=None, key=None, timeout=(5, 60), retries=5, backoff_factor=0.5, pool_size=10, cache_ttl=300):
         self.server_url = server_url
+        self.user = user or os.getenv('BIIGLE_API_USER')
+        self.key = key or os.getenv('BIIGLE_API_KEY')
+        # (connect, read) timeouts in seconds
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.cache_ttl = cache_ttl
+
+        self.cache = {}
         self.session = self.build_session()
-    
+
     def build_session(self):
         s = Session()
         s.headers = {'Accept': 'application/json'}
-        print(os.getenv('BIIGLE_API_USER'))
-        print(os.getenv('BIIGLE_API_KEY'))
-        s.auth = HTTPBasicAuth(os.getenv('BIIGLE_API_USER'), os.getenv('BIIGLE_API_KEY'))
+        s.auth = HTTPBasicAuth(self.user, self.key)
+
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
 
         return s
 
+    def get(self, endpoint, params=None, stream=False):
+        resp = self.session.get(self.server_url + endpoint, params=params, timeout=self.timeout, stream=stream)
+        resp.raise_for_status()
+        return resp
+
+    def get_json(self, endpoint, params=None):
+        """
+        GETs a metadata endpoint, the response is reused for cache_ttl seconds.
+        """
+        key = (endpoint, tuple(sorted((params or {}).items())))
+        cached = self.cache.get(key)
+
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            return cached[1]
+
+        data = self.get(endpoint, params).json()
+        self.cache[key] = (time.monotonic(), data)
+
+        return data
+
+    def clear_cache(self):
+        self.cache = {}
+
     def get_label_trees(self):
-        url = self.server_url + 'label-trees'
-        resp = self.session.get(url)
-        return resp.json()
+        return self.get_json('label-trees')
 
     def find_label_trees(self, name):
         """
         Finds a label tree id based on its name. Returns -1 if not found.
         """
-        label_trees = self.get_label_trees()
+        label_tree = self.find_label_tree(name)
+
+        return label_tree.get('id') if label_tree else -1
 
-        for label_tree in label_trees:
-            print(label_trees)
+    def find_label_tree(self, name):
+        """
+        Returns a label tree based on its name, None if not found.
+        """
+        for label_tree in self.get_label_trees():
             if label_tree.get('name') == name:
-                return label_tree.get('id')
-        
-        return -1
-    
-    def download_label_tree(self, output_path='.'):
-        url = self.server_url + 'export/label-trees'
-        output_file = os.path.join(output_path, 'label-tree.zip')
-        print(output_file)
-        resp = self.session.get(url)
-        
-        open(output_file, 'wb').write(resp.content)
+                return label_tree
+
+        return None
+
+    def download(self, endpoint, output_file, params=None):
+        """
+        Streams a response to output_file in chunks. The file only appears once complete.
+        """
+        partial = f'{output_file}.download'
+
+        with self.get(endpoint, params, stream=True) as resp:
+            with open(partial, 'wb') as file:
+                for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                    file.write(chunk)
+
+        os.replace(partial, output_file)
 
         return output_file
 
+    def download_label_tree(self, output_path='.', label_tree_id=None, file_name='label-tree.zip'):
+        """
+        Downloads the export zip of a label tree, or of all of them without label_tree_id.
+        """
+        params = {'only': label_tree_id} if label_tree_id is not None else None
 
-    
+        return self.download('export/label-trees', os.path.join(output_path, file_name), params)
 
-    
\ No newline at end of file
+    def close(self):
+        self.session.close()
@@ -0,0 +1,45 @@
+import os
+import time
+import zipfile
+
+class LabelTreeCache:
+    """
+    Local copies of BIIGLE label tree exports, keyed by label tree id and version.
+    A versioned label tree is only downloaded again when its version changes. Unversioned trees
+    can still change, their copy is downloaded again once older than max_age seconds.
+    """
+    def __init__(self, directory, max_age=24 * 3600):
+        self.directory = directory
+        self.max_age = max_age
+        # Paths downloaded by this instance, already up to date
+        self.downloaded = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, tree_id, version=None):
+        return os.path.join(self.directory, f'label-tree-{tree_id}-{version or "latest"}.zip')
+
+    def get(self, api, tree_id, version=None, refresh=False):
+        """
+        Returns the path of the export zip of a label tree, downloaded through api when missing.
+        """
+        path = self.path(tree_id, version)
+
+        if refresh or self.expired(path, version):
+            # Downloads only replace the cache entry once complete
+            api.download_label_tree(self.directory, label_tree_id=tree_id, file_name=os.path.basename(path))
+            self.downloaded.add(path)
+
+        return path
+
+    def expired(self, path, version=None):
+        if not os.path.exists(path):
+            return True
+
+        return version is None and self.max_age is not None and time.time() - os.path.getmtime(path) > self.max_age
+
+    def read(self, path):
+        """
+        Returns the JSON files of an export zip as {name: bytes}.
+        """
+        with zipfile.ZipFile(path, 'r') as archive:
+            return {name: archive.read(name) for name in archive.namelist() if name.endswith('.json')}
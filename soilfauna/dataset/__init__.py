@@ -1 +1,3 @@
-from .loader import Dataset, ImageData
\ No newline at end of file
+from .loader import Dataset, ImageData
+from .manifest import DatasetManifest
+from .duplicates import find_duplicates
\ No newline at end of file
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import cv2
+import numpy as np
+from PIL import Image
+
+DEDUPLICATE_MODES = ('content', 'perceptual')
+
+def content_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def perceptual_hash(path, grid=8, contrast=12):
+    """
+    64-bit map of the dark features of an image: one bit per cell of a grid x grid division,
+    set when the cell holds a pixel darker than its surroundings by more than contrast gray levels.
+
+    The surroundings are a heavy blur of the image, so the map does not depend on lighting, which
+    dominates plates of mostly uniform background. Re-encoded copies get the same map, or one a
+    few bits away, while different plates differ by where their organisms lie.
+    """
+    # Decoded at 1/8 of the resolution, organisms remain a few pixels wide
+    image = cv2.imread(str(path), cv2.IMREAD_REDUCED_GRAYSCALE_8).astype(np.float32)
+    detail = image - cv2.GaussianBlur(image, (0, 0), 8)
+
+    height, width = detail.shape
+    rows = np.linspace(0, height, grid + 1).astype(int)
+    cols = np.linspace(0, width, grid + 1).astype(int)
+
+    # Minimum of each cell, from the minima of each row band
+    bands = np.minimum.reduceat(detail, rows[:-1], axis=0)
+    cells = np.minimum.reduceat(bands, cols[:-1], axis=1)
+    bits = (cells < -contrast).ravel()
+
+    return int(np.packbits(bits).view('>u8')[0])
+
+def reduced_image(path):
+    return cv2.imread(str(path), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+def same_pixels(first, second, max_difference=24):
+    """
+    Whether two images decoded by reduced_image are the same picture: no pixel differs by more
+    than max_difference gray levels. Re-encoding leaves small differences everywhere, while an
+    organism present in only one of the images leaves a large one where it lies.
+    """
+    if first is None or second is None or first.shape != second.shape:
+        return False
+
+    return int(cv2.absdiff(first, second).max()) <= max_difference
+
+def find_duplicates(images, mode='content', max_distance=4, max_difference=24, max_candidates=8, manifest=None):
+    """
+    Returns {original: [duplicates]} for the ImageData found more than once, the original
+    being the first one listed.
+
+    'content' finds identical files, hashing only files whose size is shared with another one.
+    'perceptual' also finds re-encoded copies of the same dimensions. The perceptual hash only
+    selects candidates (the max_candidates nearest, within max_distance bits), as plates with few
+    features get close hashes. Annotations are only reused for candidates confirmed on their
+    pixels (see same_pixels).
+
+    With a DatasetManifest, the hashes and pixel comparisons are stored in it, only new or
+    modified files are read again. Every image is checked against its row (size and mtime) first,
+    as a file overwritten in place goes unnoticed by a refresh that does not list its directory.
+    """
+    if mode not in DEDUPLICATE_MODES:
+        raise ValueError(f'Unknown deduplication {mode!r}, expected one of {DEDUPLICATE_MODES}')
+
+    sizes = {}
+    hashes = {'content_hash': {}, 'perceptual_hash': {}}
+
+    rows = manifest.hashes() if manifest else {}
+    modified = {}
+
+    for data in images:
+        path = str(data.image_path)
+        stat = os.stat(path)
+        sizes[path] = stat.st_size
+        row = rows.get(path)
+
+        if row is None:
+            continue
+
+        if row[:2] != (stat.st_size, stat.st_mtime_ns):
+            modified[path] = (stat.st_size, stat.st_mtime_ns)
+            continue
+
+        hashes['content_hash'][path] = row[2]
+        hashes['perceptual_hash'][path] = row[3]
+
+    if modified:
+        manifest.set_modified(modified)
+
+    new_hashes = {'content_hash': {}, 'perceptual_hash': {}}
+
+    def cached_hash(data, column, compute):
+        path = str(data.image_path)
+
+        if hashes[column].get(path) is None:
+            hashes[column][path] = new_hashes[column][path] = compute(data.image_path)
+
+        return hashes[column][path]
+
+    duplicates = {}
+    originals = {}
+
+    by_size = {}
+    for data in images:
+        by_size.setdefault(sizes[str(data.image_path)], []).append(data)
+
+    unique = []
+
+    for group in by_size.values():
+        if len(group) == 1:
+            unique.extend(group)
+            continue
+
+        for data in group:
+            original = originals.setdefault(cached_hash(data, 'content_hash', content_hash), data)
+            if original is data:
+                unique.append(data)
+            else:
+                duplicates.setdefault(original, []).append(data)
+
+    new_matches = {}
+
+    if mode == 'perceptual':
+        matches = manifest.matches() if manifest else {}
+        by_dimensions = {}
+        order = {id(data): index for index, data in enumerate(images)}
+
+        for data in sorted(unique, key=lambda data: order[id(data)]):
+            if data.full_width and data.full_height:
+                dimensions = (data.full_width, data.full_height)
+            else:
+                with Image.open(data.image_path) as image:
+                    dimensions = image.size
+
+            values, kept = by_dimensions.setdefault(dimensions, ([], []))
+            # Stored as hex, SQLite integers are signed
+            value = int(cached_hash(data, 'perceptual_hash', lambda path: f'{perceptual_hash(path):016x}'), 16)
+            match = None
+
+            if values:
+                distances = np.bitwise_count(np.asarray(values, dtype=np.uint64) ^ np.uint64(value))
+                candidates = np.flatnonzero(distances <= max_distance)
+                candidates = candidates[np.argsort(distances[candidates], kind='stable')][:max_candidates]
+
+                # Decoded once for all of its candidates
+                pixels = None
+
+                for index in candidates:
+                    key = (str(kept[index].image_path), str(data.image_path))
+
+                    if key not in matches:
+                        if pixels is None:
+                            pixels = reduced_image(data.image_path)
+                        matches[key] = new_matches[key] = same_pixels(reduced_image(kept[index].image_path), pixels, max_difference)
+
+                    if matches[key]:
+                        match = kept[index]
+                        break
+
+            if match is not None:
+                found = duplicates.setdefault(match, [])
+                found.append(data)
+                found.extend(duplicates.pop(data, []))
+                continue
+
+            values.append(value)
+            kept.append(data)
+
+    if manifest:
+        for column, computed in new_hashes.items():
+            manifest.set_hashes(column, computed)
+        manifest.set_matches(new_matches)
+
+    return duplicates
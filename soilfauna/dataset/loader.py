@@ -1,18 +1,36 @@
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
+import time
 import cv2
 import json
 from typing import List
 from soilfauna.image.process import apply_kmeans
+from soilfauna.image.tiling import grid_tiles, iter_tiles
+from soilfauna.dataset.manifest import DatasetManifest
+from soilfauna.dataset.duplicates import find_duplicates
 
 class Dataset:
     """
     Dataset loader
     """
-    def __init__(self, data_path, metadata_path=None, preload=True, metadata_prefix='metadata'):
+    def __init__(self, data_path, metadata_path=None, preload=True, metadata_prefix='metadata', manifest_path=None, shard=None, deduplicate=None):
         self.data_path = data_path
         self.metadata_path = metadata_path
         self.metadata_prefix = metadata_prefix
+        self.manifest_path = manifest_path
+        # (index, count) to keep only shard index of count, see in_shard()
+        self.shard = shard
+        # None, 'content' or 'perceptual', see find_duplicates()
+        self.deduplicate = deduplicate
+
+        # Duplicates left out of data, by original
+        self.duplicates = {}
+
+        if shard and not 0 <= shard[0] < shard[1]:
+            raise ValueError(f'Shard index {shard[0]} out of range for {shard[1]} shards')
 
         self.data: List[ImageData] = []
 
@@ -20,26 +38,82 @@ class Dataset:
             self.load()
 
     def load(self, with_metadata=True):
+        """
+        Lists the images and matches their metadata file.
+        With a manifest_path, the listing comes from a DatasetManifest refreshed incrementally.
+        With a shard, only the images of the shard are kept.
+        With deduplicate, images found more than once are kept once in data, the other copies
+        are listed in duplicates under it.
+        """
+        if self.manifest_path:
+            self.load_manifest(with_metadata)
+        else:
+            self.load_files(with_metadata)
+
+        if self.shard:
+            self.data = [data for data in self.data if self.in_shard(data.image_path)]
+
+        if self.deduplicate:
+            # Hashes are kept in the manifest, only new or modified images are read
+            manifest = DatasetManifest(self.manifest_path) if self.manifest_path else None
+
+            try:
+                self.duplicates = find_duplicates(self.data, self.deduplicate, manifest=manifest)
+            finally:
+                if manifest:
+                    manifest.close()
+
+            copies = {id(data) for found in self.duplicates.values() for data in found}
+            self.data = [data for data in self.data if id(data) not in copies]
+
+    def in_shard(self, image_path):
+        """
+        Whether an image belongs to the shard. Images are assigned from a hash of their path relative
+        to the dataset, so every machine listing the dataset gets the same split.
+        """
+        index, count = self.shard
+        relative = Path(os.path.relpath(image_path, self.data_path)).as_posix()
+        digest = hashlib.sha1(relative.encode('utf-8')).digest()
+
+        return int.from_bytes(digest[:8], 'big') % count == index
+
+    def load_files(self, with_metadata=True):
         data_path = Path(self.data_path)
-        metadata_path = None
+        metadata_files = {}
 
-        if self.metadata_path:
-            metadata_path = Path(self.metadata_path)
+        if self.metadata_path and with_metadata:
+            for metadata_json in Path(self.metadata_path).rglob(f'*{self.metadata_prefix}.json'):
+                metadata_files.setdefault(metadata_json.name, metadata_json)
 
         files = list(data_path.rglob('*.jpg'))
 
         for image in files:
             name = image.stem
-            metadata_json = None
+            metadata_json = metadata_files.get(f'{name}{self.metadata_prefix}.json')
 
-            if metadata_path:
-                metadata_json = next(metadata_path.rglob(f'{name}{self.metadata_prefix}.json'), None)
-            
             self.append(
                 ImageData(image_path=image, metadata_path=metadata_json)
             )
-            
-    
+
+    def load_manifest(self, with_metadata=True):
+        manifest = DatasetManifest(self.manifest_path)
+
+        try:
+            metadata_path = self.metadata_path if with_metadata else None
+            manifest.refresh(Path(self.data_path), metadata_path and Path(metadata_path), self.metadata_prefix)
+
+            for image, metadata_json, width, height in manifest.images(Path(self.data_path)):
+                self.append(
+                    ImageData(
+                        image_path=Path(image),
+                        metadata_path=metadata_json and Path(metadata_json),
+                        width=width,
+                        height=height
+                    )
+                )
+        finally:
+            manifest.close()
+
     def __getitem__(self, index):
         return self.data[index]
     
@@ -51,6 +125,43 @@ class Dataset:
 
     def __iter__(self):
         return iter(self.data)
+
+    def stream(self, max_resident=2, load=None):
+        """
+        Yields the images loaded lazily, with at most max_resident of them holding pixels at once.
+
+        The following images are prefetched in a background thread. A yielded image is released
+        when the next one is requested, so downstream stages must be done with it by then.
+        load is an optional callable loading an ImageData, defaults to ImageData.load.
+        """
+        load = load or ImageData.load
+        images = iter(self.data)
+        pending = deque()
+
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            for data in images:
+                pending.append((data, executor.submit(load, data)))
+                if len(pending) >= max_resident:
+                    break
+
+            while pending:
+                data, future = pending.popleft()
+                future.result()
+
+                try:
+                    yield data
+                finally:
+                    data.release()
+
+                data = next(images, None)
+                if data is not None:
+                    pending.append((data, executor.submit(load, data)))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for data, _ in pending:
+                data.release()
     
     def append(self, value):
         self.data.append(value)
@@ -59,20 +170,35 @@ class ImageData:
     """
     Object holding image and json metadata
     """
-    def __init__(self, image_path: Path, metadata_path=None, crops_padding=10):
+    def __init__(self, image_path: Path, metadata_path=None, crops_padding=10, width=None, height=None):
         self.image_path = image_path
         self.metadata_path = metadata_path
         self.padding = crops_padding
 
+        # Known before loading when the image comes from a manifest
+        self.full_width = width
+        self.full_height = height
+
+        self.raw_image = None
         self.image = None
+        self.foreground = None
         self.metadata = None
 
+        # Seconds spent decoding and clustering the image by the last load()
+        self.timings = {}
+
         self.loaded = False
 
-    def load(self):
+    def load(self, kmeans=None):
+        """
+        Reads the image and its metadata. kmeans is an optional KMeansLookup fitted beforehand.
+        """
         if not self.loaded:
+            start = time.perf_counter()
             self.raw_image = self.read_image(self.image_path)
-            self.image = apply_kmeans(self.raw_image)
+            decoded = time.perf_counter()
+            self.image, self.foreground = apply_kmeans(self.raw_image, kmeans, return_mask=True)
+            self.timings = {'decode': decoded - start, 'kmeans': time.perf_counter() - decoded}
             if self.metadata_path:
                 self.metadata = self.read_json(self.metadata_path)
             self.full_height, self.full_width = self.image.shape[:2]
@@ -81,6 +207,15 @@ class ImageData:
 
         return (self.image, self.metadata)
 
+    def release(self):
+        """
+        Frees the pixel buffers. They are read again by the next load().
+        """
+        self.raw_image = None
+        self.image = None
+        self.foreground = None
+        self.loaded = False
+
     def read_image(self, image_path):
         return cv2.imread(image_path)
 
@@ -96,34 +231,25 @@ class ImageData:
         
         return None
     
+    def grid(self, rows=5, cols=5, overlap=None):
+        """
+        Lazily yields (tile, crop, raw) for a rows x cols grid, crop and raw being views
+        of the k-means and raw images. overlap defaults to the crops padding.
+        """
+        overlap = self.padding if overlap is None else overlap
+        height, width = self.image.shape[:2]
+
+        for tile in grid_tiles(height, width, rows, cols, overlap):
+            yield tile, tile.view(self.image), tile.view(self.raw_image)
+
     def get_crops(self, rows=5, cols=5):
         if not self.loaded and not self.metadata:
             return []
-        
-        crops = []
-
-        height, width, _ = self.image.shape
-
-        crop_y = height//rows
-        crop_x = width//cols
-
-        crops = []
-
-        for y in range(0, height, crop_y):
-            for x in range(0, width, crop_x):
-                x1 = max(x-self.padding, 0)
-                y1 = max(y-self.padding, 0)
-                x2 = min(x + crop_x + self.padding, width)
-                y2 = min(y + crop_y + self.padding, height)
-                crops.append(
-                    (
-                        self.image[y1:y2, x1:x2],
-                        ((x2//2), (y2//2)),
-                        (x1, y1, x2, y2),
-                        self.raw_image[y1:y2, x1:x2]
-                    )
-                )
-        return crops
+
+        return [
+            (crop, tile.center, tile.box, raw)
+            for tile, crop, raw in self.grid(rows, cols)
+        ]
         
         # for annotation in self.metadata['annotations']:
         #     for bbox in annotation['bbox']:
@@ -152,16 +278,9 @@ class ImageData:
         # return crops
     
     def slice(self, tile_height=500, tile_width=500):
-        tiles = []
+        height, width = self.image.shape[:2]
 
-        height, width, _ = self.image.shape
-
-        for i in range(0, height, tile_height):
-            for j in range(0, width, tile_width):
-                tile = self.image[i:i+tile_height, j:j+tile_width]
-                tiles.append(tile)
-        
-        return tiles
+        return [tile.view(self.image) for tile in iter_tiles(height, width, (tile_height, tile_width))]
     
     def __str__(self):
         return f'Image: {str(self.image_path)}, Metadata: {str(self.metadata_path)}'
\ No newline at end of file
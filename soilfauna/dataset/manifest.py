@@ -0,0 +1,273 @@
+import os
+import sqlite3
+from PIL import Image
+
+IMAGE_SUFFIX = '.jpg'
+METADATA_SUFFIX = '.json'
+
+class DatasetManifest:
+    """
+    Persistent SQLite index of the images of a dataset and of their metadata files.
+
+    Directories are only listed again when their mtime changed since the last refresh, and image
+    dimensions are only read for new or modified files, so reopening a large dataset is near-instant.
+    Duplicate detection hashes and pixel comparisons are kept too, and forgotten when a file changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.create_tables()
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    parent TEXT,
+                    mtime INTEGER NOT NULL,
+                    PRIMARY KEY (path, kind)
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    directory TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    metadata_path TEXT,
+                    content_hash TEXT,
+                    perceptual_hash TEXT,
+                    PRIMARY KEY (path, kind)
+                );
+                CREATE INDEX IF NOT EXISTS files_directory ON files (directory, kind);
+                CREATE TABLE IF NOT EXISTS matches (
+                    first TEXT NOT NULL,
+                    second TEXT NOT NULL,
+                    same INTEGER NOT NULL,
+                    PRIMARY KEY (first, second)
+                );
+                CREATE INDEX IF NOT EXISTS matches_second ON matches (second);
+            ''')
+
+            # Manifests written before the hash columns
+            columns = {row[1] for row in self.connection.execute('PRAGMA table_info(files)')}
+            for column in ('content_hash', 'perceptual_hash'):
+                if column not in columns:
+                    self.connection.execute(f'ALTER TABLE files ADD COLUMN {column} TEXT')
+
+    def refresh(self, data_path, metadata_path=None, metadata_prefix='metadata', full=False):
+        """
+        Updates the index from the filesystem. With full=True, every directory is listed again
+        (needed to notice files modified in place, which does not change their directory's mtime).
+        """
+        self.scan(str(data_path), 'image', IMAGE_SUFFIX, full)
+
+        if metadata_path:
+            self.scan(str(metadata_path), 'metadata', METADATA_SUFFIX, full)
+
+        self.read_dimensions()
+        self.match_metadata(str(metadata_path) if metadata_path else None, metadata_prefix)
+
+    def scan(self, root, kind, suffix, full=False):
+        cursor = self.connection.cursor()
+        seen = []
+        stack = [(root, None)]
+
+        while stack:
+            directory, parent = stack.pop()
+            mtime = os.stat(directory).st_mtime_ns
+            seen.append(directory)
+
+            known = cursor.execute(
+                'SELECT mtime FROM directories WHERE path = ? AND kind = ?', (directory, kind)
+            ).fetchone()
+
+            if not full and known and known[0] == mtime:
+                children = cursor.execute(
+                    'SELECT path FROM directories WHERE parent = ? AND kind = ?', (directory, kind)
+                ).fetchall()
+                stack.extend((child, directory) for (child,) in children)
+                continue
+
+            files = {}
+
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append((entry.path, directory))
+                    elif entry.name.endswith(suffix):
+                        stat = entry.stat()
+                        files[entry.path] = (entry.name, stat.st_size, stat.st_mtime_ns)
+
+            self.update_directory(cursor, directory, kind, parent, mtime, files)
+
+        self.remove_missing(cursor, root, kind, seen)
+        self.connection.commit()
+
+    def update_directory(self, cursor, directory, kind, parent, mtime, files):
+        known = {
+            path: (size, mtime)
+            for path, size, mtime in cursor.execute(
+                'SELECT path, size, mtime FROM files WHERE directory = ? AND kind = ?', (directory, kind)
+            )
+        }
+
+        removed = [(path, kind) for path in known if path not in files]
+        cursor.executemany('DELETE FROM files WHERE path = ? AND kind = ?', removed)
+
+        # New or modified files lose their dimensions and hashes, read again when needed
+        changed = [
+            (path, kind, directory, name, size, file_mtime)
+            for path, (name, size, file_mtime) in files.items()
+            if known.get(path) != (size, file_mtime)
+        ]
+        cursor.executemany('''
+            INSERT OR REPLACE INTO files (path, kind, directory, name, size, mtime)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', changed)
+
+        if kind == 'image':
+            self.forget_matches(cursor, [path for path, _ in removed] + [row[0] for row in changed])
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO directories (path, kind, parent, mtime) VALUES (?, ?, ?, ?)
+        ''', (directory, kind, parent, mtime))
+
+    def remove_missing(self, cursor, root, kind, seen):
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+        cursor.execute('DELETE FROM seen')
+        cursor.executemany('INSERT OR IGNORE INTO seen (path) VALUES (?)', ((path,) for path in seen))
+
+        # Only forget what lives under this root, the other kind may share directories with it
+        prefix = root.rstrip(os.sep) + os.sep
+        cursor.execute('''
+            DELETE FROM files WHERE kind = ? AND directory NOT IN (SELECT path FROM seen)
+            AND (directory = ? OR substr(directory, 1, ?) = ?)
+        ''', (kind, root, len(prefix), prefix))
+        cursor.execute('''
+            DELETE FROM directories WHERE kind = ? AND path NOT IN (SELECT path FROM seen)
+            AND (path = ? OR substr(path, 1, ?) = ?)
+        ''', (kind, root, len(prefix), prefix))
+
+        if kind == 'image':
+            cursor.execute('''
+                DELETE FROM matches WHERE first NOT IN (SELECT path FROM files WHERE kind = 'image')
+                OR second NOT IN (SELECT path FROM files WHERE kind = 'image')
+            ''')
+
+    def forget_matches(self, cursor, paths):
+        cursor.executemany('DELETE FROM matches WHERE first = ? OR second = ?', ((path, path) for path in paths))
+
+    def read_dimensions(self):
+        cursor = self.connection.cursor()
+        missing = cursor.execute(
+            "SELECT path FROM files WHERE kind = 'image' AND width IS NULL"
+        ).fetchall()
+
+        dimensions = []
+
+        for (path,) in missing:
+            # Only the header is read
+            with Image.open(path) as image:
+                width, height = image.size
+            dimensions.append((width, height, path))
+
+        cursor.executemany(
+            "UPDATE files SET width = ?, height = ? WHERE path = ? AND kind = 'image'", dimensions
+        )
+        self.connection.commit()
+
+    def match_metadata(self, metadata_path, metadata_prefix):
+        cursor = self.connection.cursor()
+        metadata = {}
+
+        if metadata_path:
+            prefix = metadata_path.rstrip(os.sep) + os.sep
+            for name, path in cursor.execute('''
+                SELECT name, path FROM files WHERE kind = 'metadata' AND (directory = ? OR substr(directory, 1, ?) = ?)
+                ORDER BY path
+            ''', (metadata_path, len(prefix), prefix)):
+                metadata.setdefault(name, path)
+
+        matches = []
+
+        for path, name in cursor.execute("SELECT path, name FROM files WHERE kind = 'image'").fetchall():
+            stem = os.path.splitext(name)[0]
+            matches.append((metadata.get(f'{stem}{metadata_prefix}{METADATA_SUFFIX}'), path))
+
+        cursor.executemany("UPDATE files SET metadata_path = ? WHERE path = ? AND kind = 'image'", matches)
+        self.connection.commit()
+
+    def images(self, data_path):
+        """
+        Returns (path, metadata_path, width, height) of the images under data_path, sorted by path.
+        """
+        root = str(data_path)
+        prefix = root.rstrip(os.sep) + os.sep
+
+        return self.connection.execute('''
+            SELECT path, metadata_path, width, height FROM files
+            WHERE kind = 'image' AND (directory = ? OR substr(directory, 1, ?) = ?)
+            ORDER BY path
+        ''', (root, len(prefix), prefix)).fetchall()
+
+    def hashes(self):
+        """
+        Returns {path: (size, mtime, content_hash, perceptual_hash)} of the images, hashes being None
+        until stored with set_hashes.
+        """
+        return {
+            path: (size, mtime, content_hash, perceptual_hash)
+            for path, size, mtime, content_hash, perceptual_hash in self.connection.execute(
+                "SELECT path, size, mtime, content_hash, perceptual_hash FROM files WHERE kind = 'image'"
+            )
+        }
+
+    def set_modified(self, files):
+        """
+        Stores the new {path: (size, mtime)} of images modified since the last refresh, forgetting
+        their dimensions, hashes and pixel comparisons.
+        """
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.executemany('''
+                UPDATE files SET size = ?, mtime = ?, width = NULL, height = NULL,
+                content_hash = NULL, perceptual_hash = NULL
+                WHERE path = ? AND kind = 'image'
+            ''', ((size, mtime, path) for path, (size, mtime) in files.items()))
+            self.forget_matches(cursor, list(files))
+
+    def set_hashes(self, column, hashes):
+        """
+        Stores {path: hash} in column, 'content_hash' or 'perceptual_hash'.
+        """
+        if column not in ('content_hash', 'perceptual_hash'):
+            raise ValueError(f'Unknown hash column {column!r}')
+
+        with self.connection:
+            self.connection.executemany(
+                f"UPDATE files SET {column} = ? WHERE path = ? AND kind = 'image'",
+                ((value, path) for path, value in hashes.items())
+            )
+
+    def matches(self):
+        """
+        Returns {(first, second): same} of the pixel comparisons of images stored with set_matches.
+        """
+        return {
+            (first, second): bool(same)
+            for first, second, same in self.connection.execute('SELECT first, second, same FROM matches')
+        }
+
+    def set_matches(self, matches):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO matches (first, second, same) VALUES (?, ?, ?)',
+                ((first, second, int(same)) for (first, second), same in matches.items())
+            )
+
+    def close(self):
+        self.connection.close()
@@ -1 +1,2 @@
-from .coco import CocoGenerator
\ No newline at end of file
+from .coco import CocoBuilder, CocoGenerator, CocoStreamWriter
+from .merge import CocoReader, merge_coco
\ No newline at end of file
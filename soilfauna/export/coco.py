@@ -1,6 +1,10 @@
 from dataclasses import dataclass, asdict, field
-from typing import List
+from typing import List, Union
+import json
+import os
+import shutil
 import cv2
+import shapely
 from shapely import Polygon, LinearRing
 import numpy as np
 
@@ -22,7 +26,8 @@ class CocoAnnotation:
     area: float
     iscrowd: int
     bbox: List[int] = field(default_factory=list)
-    segmentation: List[List[int]] = field(default_factory=list)
+    # Polygons, or a compressed RLE dict {'size': [height, width], 'counts': str}
+    segmentation: Union[List[List[int]], dict] = field(default_factory=list)
 
     def to_dict(self):
         return asdict(self)
@@ -57,15 +62,37 @@ class CocoObject:
         return asdict(self)
 
 
-class CocoGenerator:
+class CocoBuilder:
+    """
+    Adds images, categories and annotations to a COCO object. Subclasses decide where the images
+    and annotations go, through append_image and append_annotation.
+    """
     DEFAULT_CATEGORY = 'Unclassified'
 
     def __init__(self):
         self.coco = CocoObject()
 
+    @property
+    def images_count(self):
+        return self.coco.images_count
+
+    @property
+    def annotations_count(self):
+        return self.coco.annotations_count
+
+    def append_image(self, image_object: CocoImage):
+        self.coco.images.append(image_object)
+
+    def append_annotation(self, annotation_object: CocoAnnotation):
+        self.coco.annotations.append(annotation_object)
+
     def add_image(self, image, file_name):
-        id = self.coco.images_count + 1
-        height, width, _ = image.shape
+        """
+        Adds an image. `image` can be the image array or its shape.
+        """
+        id = self.images_count + 1
+        shape = image.shape if hasattr(image, 'shape') else image
+        height, width = shape[:2]
         
         image_object = CocoImage(
             id=id,
@@ -74,7 +101,7 @@ class CocoGenerator:
             file_name=file_name
         )
 
-        self.coco.images.append(image_object)
+        self.append_image(image_object)
 
         return id
     
@@ -103,7 +130,7 @@ class CocoGenerator:
         
         polygon = Polygon(points)
         
-        id = self.coco.annotations_count + 1
+        id = self.annotations_count + 1
 
         bbox = self.calculate_bbox(polygon)
         area = self.calculate_area(polygon)
@@ -118,10 +145,90 @@ class CocoGenerator:
             area=area
         )
 
-        self.coco.annotations.append(annotation_object)
+        self.append_annotation(annotation_object)
 
         return id
     
+    def add_annotations_batch(self, image_id, category_id, contours):
+        """
+        Adds all the contours of an image at once. Validity, bounding boxes and areas are computed
+        with vectorized shapely operations. Returns the ids, -1 for the contours rejected.
+        """
+        ids = [-1] * len(contours)
+
+        if not len(contours):
+            return ids
+
+        sizes = np.array([len(contour) for contour in contours])
+        coords = np.concatenate([contour.reshape(-1, 2) for contour in contours])
+
+        starts = np.cumsum(sizes) - sizes
+        closed = (coords[starts] == coords[starts + sizes - 1]).all(axis=1)
+
+        # Rings need 3 points and 4 coordinates once closed
+        valid = (sizes >= 3) & ~((sizes == 3) & closed)
+
+        if not valid.any():
+            return ids
+
+        keep = np.repeat(valid, sizes)
+        indices = np.repeat(np.arange(valid.sum()), sizes[valid])
+
+        # Open rings are closed by shapely, duplicating their first point
+        rings = shapely.linearrings(coords[keep], indices=indices)
+        polygons = shapely.polygons(rings)
+
+        is_ring = shapely.is_ring(rings)
+        bounds = shapely.bounds(polygons)
+        areas = shapely.area(polygons)
+
+        ring_coords = shapely.get_coordinates(rings).astype(np.int64)
+        ring_sizes = shapely.get_num_coordinates(rings)
+        segmentations = np.split(ring_coords, np.cumsum(ring_sizes)[:-1])
+
+        for index, ring, (minx, miny, maxx, maxy), area, points in zip(
+            np.flatnonzero(valid), is_ring, bounds.tolist(), areas.tolist(), segmentations
+        ):
+            if not ring:
+                continue
+
+            id = self.annotations_count + 1
+
+            annotation_object = CocoAnnotation(
+                id=id,
+                image_id=image_id,
+                category_id=category_id,
+                segmentation=[points.reshape(-1).tolist()],
+                bbox=[minx, miny, maxx - minx, maxy - miny],
+                iscrowd=0,
+                area=area
+            )
+
+            self.append_annotation(annotation_object)
+            ids[index] = id
+
+        return ids
+
+    def add_rle_annotation(self, image_id, category_id, rle, bbox, area):
+        """
+        Adds an annotation with a compressed RLE segmentation, as returned by rle.mask_to_rle.
+        """
+        id = self.annotations_count + 1
+
+        annotation_object = CocoAnnotation(
+            id=id,
+            image_id=image_id,
+            category_id=category_id,
+            segmentation=rle,
+            bbox=bbox,
+            iscrowd=0,
+            area=area
+        )
+
+        self.append_annotation(annotation_object)
+
+        return id
+
     def calculate_bbox(self, polygon: Polygon):
         minx, miny, maxx, maxy = polygon.bounds
 
@@ -132,7 +239,94 @@ class CocoGenerator:
 
     def calculate_area(self, polygon: Polygon):
         return polygon.area
-    
+
+
+class CocoGenerator(CocoBuilder):
+    """
+    COCO object kept in memory, returned as a dict by generate().
+    """
     def generate(self):
         return self.coco.to_dict()
-        
\ No newline at end of file
+
+
+class CocoStreamWriter(CocoBuilder):
+    """
+    Writes images and annotations to disk as they are added, as compact JSON.
+
+    Images and annotations are appended to two part files next to `path`, only the categories
+    are kept in memory. close() assembles the final COCO file and removes the part files,
+    discard() only removes them. Used as a context manager, the writer is closed on success
+    and discarded on error.
+    """
+    SEPARATORS = (',', ':')
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+        self.images_written = 0
+        self.annotations_written = 0
+
+        self.images_file = open(f'{path}.images.part', 'w', encoding='utf-8')
+        self.annotations_file = open(f'{path}.annotations.part', 'w', encoding='utf-8')
+
+    @property
+    def images_count(self):
+        return self.images_written
+
+    @property
+    def annotations_count(self):
+        return self.annotations_written
+
+    def write(self, file, count, coco_object):
+        if count:
+            file.write(',')
+        file.write(json.dumps(vars(coco_object), ensure_ascii=False, separators=self.SEPARATORS))
+
+    def append_image(self, image_object: CocoImage):
+        self.write(self.images_file, self.images_written, image_object)
+        self.images_written += 1
+
+    def append_annotation(self, annotation_object: CocoAnnotation):
+        self.write(self.annotations_file, self.annotations_written, annotation_object)
+        self.annotations_written += 1
+
+    def close(self):
+        self.images_file.close()
+        self.annotations_file.close()
+
+        categories = [vars(category) for category in self.coco.categories]
+
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.write('{"images":[')
+            with open(self.images_file.name, 'r', encoding='utf-8') as part:
+                shutil.copyfileobj(part, file)
+
+            file.write('],"categories":')
+            file.write(json.dumps(categories, ensure_ascii=False, separators=self.SEPARATORS))
+
+            file.write(',"annotations":[')
+            with open(self.annotations_file.name, 'r', encoding='utf-8') as part:
+                shutil.copyfileobj(part, file)
+
+            file.write(']}')
+
+        os.remove(self.images_file.name)
+        os.remove(self.annotations_file.name)
+
+    def discard(self):
+        self.images_file.close()
+        self.annotations_file.close()
+
+        for part in (self.images_file.name, self.annotations_file.name):
+            if os.path.exists(part):
+                os.remove(part)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
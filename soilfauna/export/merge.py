@@ -0,0 +1,161 @@
+"""
+Streaming merge of COCO files, e.g. the outputs of a dataset segmented in shards.
+
+Files are read one item at a time, so only the categories and the current item are held in memory.
+"""
+import json
+from soilfauna.export.coco import CocoAnnotation, CocoCategory, CocoImage, CocoStreamWriter
+
+CHUNK_SIZE = 1 << 20
+WHITESPACE = ' \t\n\r'
+
+class CocoReader:
+    """
+    Iterates over the top-level entries of a COCO file without loading it. Arrays are
+    yielded item by item as (key, item), other values as (key, value).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as file:
+            self.file = file
+            self.buffer = ''
+            self.position = 0
+            self.eof = False
+
+            self.expect('{')
+
+            if self.peek() == '}':
+                return
+
+            while True:
+                key = self.decode()
+                self.expect(':')
+
+                if self.peek() == '[':
+                    self.position += 1
+                    if self.peek() == ']':
+                        self.position += 1
+                    else:
+                        while True:
+                            yield key, self.decode()
+                            if self.separator(']'):
+                                break
+                else:
+                    yield key, self.decode()
+
+                if self.separator('}'):
+                    return
+
+    def fill(self):
+        chunk = self.file.read(CHUNK_SIZE)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.eof = not chunk
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if self.eof:
+                raise ValueError(f'{self.path}: unexpected end of file')
+            self.fill()
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError(f'{self.path}: expected {character!r} at offset {self.position}')
+        self.position += 1
+
+    def separator(self, end):
+        """
+        Consumes a ',' or the end character, returns True at the end.
+        """
+        character = self.peek()
+        self.position += 1
+
+        if character == end:
+            return True
+        if character != ',':
+            raise ValueError(f'{self.path}: expected \',\' or {end!r} at offset {self.position - 1}')
+
+        return False
+
+    def decode(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+
+            # A number could continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self.fill()
+                continue
+
+            self.position = end
+            return value
+
+def read_categories(path):
+    return [item for key, item in CocoReader(path) if key == 'categories']
+
+def merge_coco(paths, output):
+    """
+    Merges COCO files into output. Image and annotation ids are shifted past the ids of the
+    previous files, categories are merged by name.
+    """
+    # The part files are removed if a file can not be read
+    with CocoStreamWriter(output) as writer:
+        categories = {}
+
+        image_offset = 0
+        annotation_offset = 0
+
+        def add_categories(items):
+            mapping = {}
+            for category in items:
+                if category['name'] not in categories:
+                    categories[category['name']] = len(categories) + 1
+                    writer.coco.categories.append(CocoCategory(id=categories[category['name']], name=category['name']))
+                mapping[category['id']] = categories[category['name']]
+            return mapping
+
+        for path in paths:
+            category_ids = {}
+            read_ahead = False
+            max_image_id = 0
+            max_annotation_id = 0
+
+            for key, item in CocoReader(path):
+                if key == 'images':
+                    max_image_id = max(max_image_id, item['id'])
+                    item['id'] += image_offset
+                    writer.append_image(CocoImage(**item))
+                elif key == 'categories' and not read_ahead:
+                    category_ids.update(add_categories([item]))
+                elif key == 'annotations':
+                    if not category_ids:
+                        # Categories are written after the annotations in this file
+                        category_ids = add_categories(read_categories(path))
+                        read_ahead = True
+
+                    max_annotation_id = max(max_annotation_id, item['id'])
+                    item['id'] += annotation_offset
+                    item['image_id'] += image_offset
+                    item['category_id'] = category_ids[item['category_id']]
+                    writer.append_annotation(CocoAnnotation(**item))
+
+            image_offset += max_image_id
+            annotation_offset += max_annotation_id
+
+    return writer.images_count, writer.annotations_count
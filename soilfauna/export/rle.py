@@ -0,0 +1,143 @@
+"""
+COCO run-length encoding of binary masks.
+
+Masks are flattened in column-major order, counts alternate between runs of 0 and 1
+starting with 0, and are compressed to the string format used by pycocotools.
+"""
+import numpy as np
+
+def encode_runs(mask, offset=(0, 0), size=None):
+    """
+    Returns the run counts of a boolean mask placed at offset (x, y) in an image of
+    size (height, width), which defaults to the mask shape.
+    """
+    mask_height, mask_width = mask.shape
+    height, width = size or mask.shape
+    x, y = offset
+
+    # Columns become rows, padded with a zero on both ends so runs never cross a column
+    columns = np.zeros((mask_width, mask_height + 2), dtype=np.int8)
+    columns[:, 1:-1] = mask.T
+    changes = np.diff(columns, axis=1)
+
+    start_columns, start_rows = np.nonzero(changes == 1)
+    end_columns, end_rows = np.nonzero(changes == -1)
+
+    starts = (x + start_columns) * height + y + start_rows
+    ends = (x + end_columns) * height + y + end_rows
+
+    # Runs touching from one column to the next are a single run in the image
+    if len(starts):
+        joined = ends[:-1] == starts[1:]
+        starts = starts[np.concatenate([[True], ~joined])]
+        ends = ends[np.concatenate([~joined, [True]])]
+
+    boundaries = np.empty(2 * len(starts), dtype=np.int64)
+    boundaries[0::2] = starts
+    boundaries[1::2] = ends
+
+    counts = np.diff(np.concatenate([[0], boundaries, [height * width]]))
+
+    # No trailing empty run when the mask ends on the last pixel
+    if len(counts) > 1 and counts[-1] == 0:
+        counts = counts[:-1]
+
+    return counts
+
+def runs_area(counts):
+    return int(np.sum(counts[1::2]))
+
+def runs_bbox(counts, height):
+    """
+    Returns the [x, y, width, height] bounding box of run counts in an image of the given height.
+    """
+    boundaries = np.cumsum(counts)
+    starts = boundaries[0::2][:len(counts) // 2]
+    ends = boundaries[1::2]
+
+    if not len(ends):
+        return [0, 0, 0, 0]
+
+    start_x, start_y = np.divmod(starts, height)
+    end_x, end_y = np.divmod(ends - 1, height)
+
+    x1, x2 = int(start_x.min()), int(end_x.max())
+
+    # A run spanning several columns covers their full height
+    if (start_x != end_x).any():
+        y1, y2 = 0, int(height) - 1
+    else:
+        y1, y2 = int(start_y.min()), int(end_y.max())
+
+    return [x1, y1, x2 - x1 + 1, y2 - y1 + 1]
+
+def compress(counts):
+    """
+    Compresses run counts to the pycocotools string format.
+    """
+    counts = np.asarray(counts).tolist()
+    characters = []
+
+    for i, count in enumerate(counts):
+        value = count - counts[i - 2] if i > 2 else count
+        more = True
+
+        while more:
+            character = value & 0x1f
+            value >>= 5
+            more = value != -1 if character & 0x10 else value != 0
+            if more:
+                character |= 0x20
+            characters.append(chr(character + 48))
+
+    return ''.join(characters)
+
+def decompress(string):
+    counts = []
+    position = 0
+
+    while position < len(string):
+        value = 0
+        shift = 0
+        more = True
+
+        while more:
+            character = ord(string[position]) - 48
+            value |= (character & 0x1f) << shift
+            more = character & 0x20
+            position += 1
+            shift += 5
+            if not more and character & 0x10:
+                value |= -1 << shift
+
+        if len(counts) > 2:
+            value += counts[-2]
+        counts.append(value)
+
+    return np.asarray(counts, dtype=np.int64)
+
+def mask_to_rle(mask, offset=(0, 0), size=None):
+    """
+    Encodes a boolean mask placed at offset (x, y) in an image of size (height, width).
+    Returns the COCO segmentation, its bbox and its area.
+    """
+    height, width = size or mask.shape
+    counts = encode_runs(mask, offset, (height, width))
+
+    rle = {
+        'size': [height, width],
+        'counts': compress(counts)
+    }
+
+    return rle, runs_bbox(counts, height), runs_area(counts)
+
+def decode(rle):
+    """
+    Decodes a COCO compressed RLE segmentation to a boolean mask.
+    """
+    height, width = rle['size']
+    counts = decompress(rle['counts'])
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+
+    return np.repeat(values, counts).reshape((width, height)).T
@@ -2,52 +2,164 @@ import cv2
 import numpy as np
 from sklearn.cluster import KMeans
 
+KMEANS_INIT_CENTERS = np.asarray([
+    [79.49, 130.62, 189.84],
+    [131.84, 107.86, 76.36],
+    [178.59, 173.83, 159.51],
+    [47.20, 28.64, 18.90],
+    [114.45, 146.57, 187.97]
+])
+
 def process_crop(crop):
     kernel = np.ones((3,3), np.uint8)
     eroded = cv2.morphologyEx(crop, cv2.MORPH_DILATE, kernel, iterations=8)
     return eroded
 
-def apply_kmeans(image):
+class KMeansLookup:
+    """
+    Nearest k-means center of every quantized RGB colour.
+
+    Centers are fitted once (e.g. per batch folder), labelling an image is then a single
+    indexed gather in the table instead of a k-means fit.
+    """
+    def __init__(self, centers, bits=6):
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.bits = bits
+        self.table = self.build_table()
+
+    @classmethod
+    def fit(cls, images, sample_size=100000, bits=6, random_state=42):
+        """
+        Fits the centers on a random subsample of the pixels of the given BGR images.
+        """
+        rng = np.random.default_rng(random_state)
+        per_image = max(1, sample_size // max(1, len(images)))
+        samples = []
+
+        for image in images:
+            pixels = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).reshape(-1, 3)
+            index = rng.choice(len(pixels), size=min(per_image, len(pixels)), replace=False)
+            samples.append(pixels[index])
+
+        kmeans = KMeans(n_clusters=len(KMEANS_INIT_CENTERS), init=KMEANS_INIT_CENTERS, random_state=random_state)
+        kmeans.fit(np.concatenate(samples).astype(np.float64))
+
+        return cls(kmeans.cluster_centers_, bits=bits)
+
+    def build_table(self):
+        levels = 1 << self.bits
+        step = 256 / levels
+        values = np.arange(levels) * step + step / 2
+
+        r, g, b = np.meshgrid(values, values, values, indexing='ij')
+        colors = np.stack([r, g, b], axis=-1).reshape(-1, 1, 3)
+        distances = ((colors - self.centers[None]) ** 2).sum(axis=-1)
+
+        return distances.argmin(axis=1).astype(np.uint8)
+
+    def predict(self, rgb_image):
+        """
+        Returns the cluster label of every pixel of an RGB image (any shape ending with 3 channels).
+        """
+        shift = 8 - self.bits
+        quantized = (rgb_image >> shift).astype(np.intp)
+        index = (quantized[..., 0] << (2 * self.bits)) | (quantized[..., 1] << self.bits) | quantized[..., 2]
+
+        return self.table[index]
+
+def apply_kmeans(image, lookup=None, return_mask=False):
+    """
+    Clusters the pixels of a BGR image and whitens the background clusters. Returns an RGB image.
+
+    Without lookup, k-means is fitted on every pixel of the image. With a KMeansLookup,
+    pixels are labelled through its precomputed table.
+    With return_mask, also returns the boolean foreground mask (pixels that are not white).
+    """
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    shape = image.shape
-    rgb_image = image.reshape(-1, 3)
-    kmeans_init_centers = np.asarray([
-        [79.49, 130.62, 189.84],
-        [131.84, 107.86, 76.36],
-        [178.59, 173.83, 159.51],
-        [47.20, 28.64, 18.90],
-        [114.45, 146.57, 187.97]
-    ])
-
-    kmeans = KMeans(n_clusters=5, init=kmeans_init_centers, random_state=42)
-    cluster_labels = kmeans.fit_predict(rgb_image)
-    
-    ratio = 1
-    total_pixels = len(cluster_labels)
 
-    total_0 = np.count_nonzero(cluster_labels == 0)
-    total_4 = np.count_nonzero(cluster_labels == 4)
+    if lookup is None:
+        kmeans = KMeans(n_clusters=len(KMEANS_INIT_CENTERS), init=KMEANS_INIT_CENTERS, random_state=42)
+        cluster_labels = kmeans.fit_predict(image.reshape(-1, 3)).reshape(image.shape[:2])
+    else:
+        cluster_labels = lookup.predict(image)
+
+    ratio = 1
+    total_pixels = cluster_labels.size
+    counts = np.bincount(cluster_labels.ravel(), minlength=len(KMEANS_INIT_CENTERS))
 
-    print(f'Total pixels: {total_pixels}')
+    keep = np.ones(len(counts), dtype=bool)
 
-    if total_0 + total_4 >= ratio * total_pixels:
-        print(f'Class removed: {0}')
-        mask = ~np.isin(cluster_labels, [0])
+    if counts[0] + counts[4] >= ratio * total_pixels:
+        keep[0] = False
     else:
-        print(f'Class removed: {0, 4}')
-        mask = ~np.isin(cluster_labels, [0, 4])
+        keep[[0, 4]] = False
 
-    img_array = np.array(rgb_image)
-    new_img = np.full_like(img_array, 255)
-    new_img[mask] = img_array[mask]
+    mask = keep[cluster_labels]
 
-    new_img = new_img.reshape(shape)
+    new_img = np.full_like(image, 255)
+    new_img[mask] = image[mask]
+
+    if return_mask:
+        # Same as the inverse of convert_to_binary, without the 3-channel copies
+        foreground = mask & (image.min(axis=-1) < 255)
+        return new_img, foreground
 
     return new_img
 
+def find_prompt_points(foreground, tiles=None, ratio=0.2):
+    """
+    Finds SAM point prompts in a foreground mask in one pass.
+
+    The distance map of the foreground is thresholded at ratio times its maximum (taken per
+    tile core when tiles are given) and the centroids of its connected components are returned
+    as (N, 2) integer image coordinates, along with the thresholded map.
+    """
+    dist = cv2.distanceTransform(foreground.astype(np.uint8), cv2.DIST_L2, 5)
+    height, width = dist.shape
+    cores = [tile.core for tile in tiles] if tiles else [(0, 0, width, height)]
+
+    dist_thresh = np.zeros((height, width), dtype=np.uint8)
+
+    for x1, y1, x2, y2 in cores:
+        region = dist[y1:y2, x1:x2]
+        if region.size:
+            dist_thresh[y1:y2, x1:x2] = region > ratio * region.max()
+
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(dist_thresh, connectivity=8)
+
+    # Skip the background label and components without area (lines and single pixels)
+    valid = (stats[1:, cv2.CC_STAT_WIDTH] > 1) & (stats[1:, cv2.CC_STAT_HEIGHT] > 1)
+
+    return centroids[1:][valid].astype(np.int64), dist_thresh
+
+def prompt_boxes(foreground, points, padding=0):
+    """
+    Bounding boxes (N, 4) of x1, y1, x2, y2 of the foreground objects holding the prompt points,
+    grown by padding pixels. A point outside the foreground gets a box around itself.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(foreground.astype(np.uint8), connectivity=8)
+    height, width = labels.shape
+
+    found = stats[labels[points[:, 1], points[:, 0]]]
+    boxes = np.stack([
+        found[:, cv2.CC_STAT_LEFT],
+        found[:, cv2.CC_STAT_TOP],
+        found[:, cv2.CC_STAT_LEFT] + found[:, cv2.CC_STAT_WIDTH],
+        found[:, cv2.CC_STAT_TOP] + found[:, cv2.CC_STAT_HEIGHT]
+    ], axis=1)
+
+    # Label 0 is the background, its box is the whole image
+    outside = labels[points[:, 1], points[:, 0]] == 0
+    boxes[outside] = np.concatenate([points[outside], points[outside] + 1], axis=1)
+
+    boxes += (-padding, -padding, padding, padding)
+
+    return np.clip(boxes, 0, (width, height, width, height))
+
 def convert_to_binary(image):
     mask = (image == [255, 255, 255]).all(axis=-1)
     result = np.zeros_like(image)
     result[mask] = [255, 255, 255]
 
-    return result
\ No newline at end of file
+    return result
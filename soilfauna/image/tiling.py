@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+from typing import Tuple
+import math
+import numpy as np
+
+# Rough peak memory per tile pixel of the crop analysis (k-means and raw views, binary, distance map)
+TILE_BYTES_PER_PIXEL = 24
+DEFAULT_TILE_MEMORY = 64 * 1024 * 1024
+
+@dataclass(frozen=True)
+class Tile:
+    """
+    Region of an image. (x1, y1, x2, y2) includes the overlap, core is the region the tile owns.
+    Cores of the tiles of an image do not overlap and cover the whole image.
+    """
+    x1: int
+    y1: int
+    x2: int
+    y2: int
+    core: Tuple[int, int, int, int]
+
+    @property
+    def box(self):
+        return (self.x1, self.y1, self.x2, self.y2)
+
+    @property
+    def center(self):
+        """
+        Center of the tile, relative to the tile.
+        """
+        return ((self.x2 - self.x1) // 2, (self.y2 - self.y1) // 2)
+
+    def view(self, image):
+        """
+        Zero-copy view of the tile in an image.
+        """
+        return image[self.y1:self.y2, self.x1:self.x2]
+
+    def owns(self, points):
+        """
+        Boolean mask of the (N, 2) image coordinates points lying in the core of the tile.
+        """
+        points = np.asarray(points).reshape(-1, 2)
+        cx1, cy1, cx2, cy2 = self.core
+
+        return (
+            (points[:, 0] >= cx1) & (points[:, 0] < cx2) &
+            (points[:, 1] >= cy1) & (points[:, 1] < cy2)
+        )
+
+    def grow(self, boxes, height, width):
+        """
+        Tile extended to cover boxes ((N, 4) x1, y1, x2, y2 image coordinates), within a
+        height x width image. The core is unchanged.
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4)
+
+        if not len(boxes):
+            return self
+
+        return Tile(
+            x1=max(min(self.x1, int(boxes[:, 0].min())), 0),
+            y1=max(min(self.y1, int(boxes[:, 1].min())), 0),
+            x2=min(max(self.x2, int(boxes[:, 2].max())), width),
+            y2=min(max(self.y2, int(boxes[:, 3].max())), height),
+            core=self.core
+        )
+
+    def to_tile(self, points):
+        """
+        Converts (N, 2) image coordinates to tile coordinates.
+        """
+        return np.asarray(points).reshape(-1, 2) - (self.x1, self.y1)
+
+def choose_tile_size(height, width, memory_budget=DEFAULT_TILE_MEMORY, overlap=0, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+    """
+    Largest tile side whose padded tile fits in memory_budget bytes, capped to the image size.
+    """
+    side = int(math.sqrt(memory_budget / bytes_per_pixel)) - 2 * overlap
+    return max(1, min(side, max(height, width)))
+
+def grid_tiles(height, width, rows, cols, overlap=0):
+    """
+    Lazily yields rows x cols tiles of evenly distributed sizes, padded by overlap pixels.
+    """
+    for row in range(rows):
+        cy1 = row * height // rows
+        cy2 = (row + 1) * height // rows
+
+        for col in range(cols):
+            cx1 = col * width // cols
+            cx2 = (col + 1) * width // cols
+
+            yield Tile(
+                x1=max(cx1 - overlap, 0),
+                y1=max(cy1 - overlap, 0),
+                x2=min(cx2 + overlap, width),
+                y2=min(cy2 + overlap, height),
+                core=(cx1, cy1, cx2, cy2)
+            )
+
+def iter_tiles(height, width, tile_size, overlap=0):
+    """
+    Lazily yields tiles whose core is at most tile_size (int or (tile_height, tile_width)), padded by overlap.
+    """
+    tile_height, tile_width = (tile_size, tile_size) if isinstance(tile_size, int) else tile_size
+
+    rows = max(1, math.ceil(height / tile_height))
+    cols = max(1, math.ceil(width / tile_width))
+
+    return grid_tiles(height, width, rows, cols, overlap)
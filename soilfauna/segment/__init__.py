@@ -1 +1,2 @@
-from .segment import *
\ No newline at end of file
+from .segment import *
+from .options import SegmentOptions
\ No newline at end of file
@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+import cv2
+import numpy as np
+
+FIGURE_LEVELS = ('none', 'sample', 'all')
+
+def figure_selection(count, level='all', sample=10):
+    """
+    Returns the indexes of the images getting diagnostic figures: none, `sample` evenly spaced images, or all.
+    """
+    if level not in FIGURE_LEVELS:
+        raise ValueError(f'Unknown figures level {level!r}, expected one of {FIGURE_LEVELS}')
+
+    if level == 'all':
+        return range(count)
+
+    if level == 'sample' and sample > 0:
+        return range(0, count, max(1, -(-count // sample)))
+
+    return range(0)
+
+def fit_size(figure, max_size):
+    height, width = figure.shape[:2]
+    scale = max_size / max(height, width)
+
+    if scale >= 1:
+        return figure
+
+    return cv2.resize(figure, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+def write_crop_figure(path, crop, centers, dist_thresh, max_size):
+    """
+    Writes the k-means crop with its prompt points next to the thresholded distance map.
+    """
+    crop = cv2.cvtColor(crop, cv2.COLOR_RGB2BGR)
+
+    for cx, cy in centers:
+        cv2.circle(crop, (cx, cy), 3, (0, 0, 255), -1)
+
+    dist = cv2.cvtColor(dist_thresh * 255, cv2.COLOR_GRAY2BGR)
+
+    cv2.imwrite(path, fit_size(np.hstack([crop, dist]), max_size))
+
+def write_image_figure(path, image, mask, contours, max_size):
+    """
+    Writes the k-means image with the mask contours next to the mask (black on white).
+    """
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    cv2.drawContours(image, contours, -1, (0, 255, 0), 3)
+
+    mask = cv2.cvtColor(np.where(mask > 0, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+    cv2.imwrite(path, fit_size(np.hstack([image, mask]), max_size))
+
+class FigureWriter:
+    """
+    Renders diagnostic figures in a background thread pool, off the inference loop.
+    At most max_pending figures wait to be written, submitting more blocks until one is done.
+    """
+    def __init__(self, crop_output, processed_output, workers=2, max_pending=8, max_size=2048):
+        self.crop_output = crop_output
+        self.processed_output = processed_output
+        self.max_size = max_size
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = BoundedSemaphore(max_pending)
+
+    def submit(self, function, *args):
+        self.slots.acquire()
+        future = self.executor.submit(function, *args, self.max_size)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.slots.release()
+
+        if future.exception():
+            print(f'Figure not written: {future.exception()}')
+
+    def crop(self, name, index, crop, centers, dist_thresh):
+        # Buffers are copied, the image is released or modified while the figure waits
+        self.submit(write_crop_figure, f'{self.crop_output}/c{index}_{name}.png', crop.copy(), centers, dist_thresh.copy())
+
+    def image(self, name, image, mask, contours):
+        self.submit(write_image_figure, f'{self.processed_output}/fig_{name}.png', image.copy(), mask.copy(), contours)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
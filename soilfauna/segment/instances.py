@@ -0,0 +1,205 @@
+from dataclasses import dataclass
+from typing import List
+import cv2
+import numpy as np
+
+from soilfauna.export.rle import mask_to_rle
+
+@dataclass
+class Instance:
+    """
+    Mask of one object trimmed to its bounding box, (x, y) being its offset in the image.
+    clipped is set when the mask reaches the border of the predicted view inside the image,
+    the object may then go on in a neighbouring tile.
+    """
+    x: int
+    y: int
+    mask: np.ndarray
+    clipped: bool = False
+
+    @classmethod
+    def from_mask(cls, mask, offset=(0, 0)):
+        """
+        Trims a boolean mask to its bounding box. Returns None for an empty mask.
+        """
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+
+        if not len(rows):
+            return None
+
+        y1, y2 = rows[0], rows[-1] + 1
+        x1, x2 = cols[0], cols[-1] + 1
+
+        # Copied so the full-size mask can be freed
+        return cls(int(offset[0] + x1), int(offset[1] + y1), mask[y1:y2, x1:x2].copy())
+
+    @property
+    def box(self):
+        height, width = self.mask.shape
+        return (self.x, self.y, self.x + width, self.y + height)
+
+    @property
+    def area(self):
+        return int(np.count_nonzero(self.mask))
+
+    def contour(self):
+        """
+        Largest external contour of the mask, in image coordinates. Returns None when there is none.
+        """
+        contours, _ = cv2.findContours(
+            self.mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1, offset=(self.x, self.y)
+        )
+
+        if not contours:
+            return None
+
+        return max(contours, key=cv2.contourArea)
+
+    def rle(self, size):
+        """
+        Returns (rle, bbox, area) of the mask in an image of size (height, width).
+        """
+        return mask_to_rle(self.mask, (self.x, self.y), size)
+
+    def overlap(self, other):
+        """
+        Intersection of both masks over the area of the smallest one.
+        """
+        ax1, ay1, ax2, ay2 = self.box
+        bx1, by1, bx2, by2 = other.box
+        x1, y1, x2, y2 = max(ax1, bx1), max(ay1, by1), min(ax2, bx2), min(ay2, by2)
+
+        if x1 >= x2 or y1 >= y2:
+            return 0
+
+        a = self.mask[y1 - ay1:y2 - ay1, x1 - ax1:x2 - ax1]
+        b = other.mask[y1 - by1:y2 - by1, x1 - bx1:x2 - bx1]
+        intersection = np.count_nonzero(a & b)
+
+        return intersection / max(1, min(self.area, other.area))
+
+    def touches(self, other):
+        """
+        Whether both masks overlap or have 8-connected neighbouring pixels.
+        """
+        ax1, ay1, ax2, ay2 = self.box
+        bx1, by1, bx2, by2 = other.box
+        # Window of the box of self grown by one pixel, where it meets other
+        x1, y1, x2, y2 = max(ax1 - 1, bx1), max(ay1 - 1, by1), min(ax2 + 1, bx2), min(ay2 + 1, by2)
+
+        if x1 >= x2 or y1 >= y2:
+            return False
+
+        grown = cv2.dilate(np.pad(self.mask, 1).astype(np.uint8), np.ones((3, 3), np.uint8))
+        a = grown[y1 - ay1 + 1:y2 - ay1 + 1, x1 - ax1 + 1:x2 - ax1 + 1]
+        b = other.mask[y1 - by1:y2 - by1, x1 - bx1:x2 - bx1]
+
+        return bool(np.any(a.astype(bool) & b))
+
+    def union(self, other):
+        x1, y1 = min(self.x, other.x), min(self.y, other.y)
+        x2, y2 = max(self.box[2], other.box[2]), max(self.box[3], other.box[3])
+
+        mask = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+
+        for instance in (self, other):
+            ix1, iy1, ix2, iy2 = instance.box
+            mask[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] |= instance.mask
+
+        return Instance(x1, y1, mask)
+
+def result_instances(result, offset=(0, 0), size=None):
+    """
+    Yields the instances of the masks of an ultralytics result, offset (x, y) being the origin
+    of the predicted image. Only the bounding box of each mask is copied off the device.
+    With the (height, width) size of the whole image, instances reaching a border of the
+    predicted image that is not a border of the image are marked clipped.
+    """
+    if result.masks is None:
+        return
+
+    for mask in result.masks.data:
+        view_height, view_width = mask.shape[-2:]
+
+        rows = np.flatnonzero(mask.any(1).cpu().numpy())
+        cols = np.flatnonzero(mask.any(0).cpu().numpy())
+
+        if not len(rows):
+            continue
+
+        y1, y2 = rows[0], rows[-1] + 1
+        x1, x2 = cols[0], cols[-1] + 1
+
+        clipped = size is not None and bool(
+            (x1 == 0 and offset[0] > 0) or (y1 == 0 and offset[1] > 0) or
+            (x2 == view_width and offset[0] + view_width < size[1]) or
+            (y2 == view_height and offset[1] + view_height < size[0])
+        )
+
+        yield Instance(int(offset[0] + x1), int(offset[1] + y1), mask[y1:y2, x1:x2].cpu().numpy().astype(bool), clipped)
+
+def merge_duplicates(instances: List[Instance], threshold=0.8):
+    """
+    Merges instances overlapping by at least threshold of the smallest one, as several prompts
+    of the same object give near-identical masks. Touching objects stay separate.
+    """
+    kept: List[Instance] = []
+
+    for instance in sorted(instances, key=lambda instance: instance.area, reverse=True):
+        for i, other in enumerate(kept):
+            if instance.overlap(other) >= threshold:
+                kept[i] = other.union(instance)
+                break
+        else:
+            kept.append(instance)
+
+    return kept
+
+def merge_clipped(instances: List[Instance]):
+    """
+    Merges the pieces of objects cut at a tile seam: clipped instances are joined with the
+    instances their mask touches.
+    """
+    parents = list(range(len(instances)))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, instance in enumerate(instances):
+        if not instance.clipped:
+            continue
+
+        for j, other in enumerate(instances):
+            if j != i and instance.touches(other):
+                parents[root(j)] = root(i)
+
+    groups = {}
+    for i, instance in enumerate(instances):
+        groups.setdefault(root(i), []).append(instance)
+
+    merged = []
+
+    for group in groups.values():
+        instance = group[0]
+        for other in group[1:]:
+            instance = instance.union(other)
+        merged.append(instance)
+
+    return merged
+
+def instance_map(instances: List[Instance], height, width):
+    """
+    int32 map of the instance ids (index + 1), 0 being the background. Overlaps go to the first instance.
+    """
+    ids = np.zeros((height, width), dtype=np.int32)
+
+    for i, instance in enumerate(instances, start=1):
+        x1, y1, x2, y2 = instance.box
+        region = ids[y1:y2, x1:x2]
+        region[instance.mask & (region == 0)] = i
+
+    return ids
@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+import json
+import sys
+import time
+import psutil
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+STAGES = ('decode', 'kmeans', 'prompts', 'sam', 'contours', 'figures', 'export')
+
+class StageTimer:
+    """
+    Wall time spent in each stage of the segmentation of one image, in seconds.
+    """
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def update(self, stages):
+        for name, seconds in stages.items():
+            self.add(name, seconds)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+def peak_rss():
+    """
+    High-water mark of the resident memory of the current process in bytes, kept by the kernel,
+    so peaks in the middle of a stage count. None on Windows.
+    """
+    if resource is None:
+        return None
+
+    # Kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+class RunMetrics:
+    """
+    Collects the stage timings of every image of a run, with throughput, ETA and resident memory
+    (the process and its workers). Each image is reported on one line, and written as a JSON line
+    to path when given, followed by a summary line at the end of the run.
+
+    The per-image RSS is sampled when the image is done. The summary reports the peaks recorded
+    by the kernel instead: the main process, and the largest worker, each worker reporting its
+    own peak with its results (see record).
+    """
+    def __init__(self, total, path=None):
+        self.total = total
+        self.count = 0
+        self.stages = {}
+        self.peak_worker_rss = None
+
+        self.process = psutil.Process()
+        self.start = time.perf_counter()
+        self.file = open(path, 'a', encoding='utf-8') if path else None
+
+    def rss(self):
+        processes = [self.process] + self.process.children(recursive=True)
+        total = 0
+
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                # Worker exited in the meantime
+                pass
+
+        return total
+
+    def write(self, record):
+        if self.file:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def record(self, name, stages, worker_rss=None):
+        """
+        Reports an image. worker_rss is the peak RSS of the worker process that segmented it.
+        """
+        self.count += 1
+
+        if worker_rss is not None:
+            self.peak_worker_rss = max(self.peak_worker_rss or 0, worker_rss)
+
+        for stage, seconds in stages.items():
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+        elapsed = time.perf_counter() - self.start
+        rate = self.count / elapsed if elapsed else 0
+        eta = (self.total - self.count) / rate if rate else 0
+
+        rss = self.rss()
+
+        self.write({
+            'type': 'image',
+            'image': name,
+            'index': self.count,
+            'total': self.total,
+            'stages': stages,
+            'images_per_second': rate,
+            'eta': eta,
+            'rss': rss
+        })
+
+        print(
+            f'[{self.count}/{self.total}] {name}: {sum(stages.values()):.2f}s, '
+            f'{rate:.2f} images/s, ETA {format_duration(eta)}, RSS {rss / 2**20:.0f} MiB'
+        )
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        stage_total = sum(self.stages.values())
+
+        return {
+            'type': 'summary',
+            'images': self.count,
+            'wall_time': elapsed,
+            'images_per_second': self.count / elapsed if elapsed else 0,
+            'peak_rss': peak_rss(),
+            'peak_worker_rss': self.peak_worker_rss,
+            'stages': {
+                stage: {
+                    'total': seconds,
+                    'mean': seconds / self.count if self.count else 0,
+                    'share': seconds / stage_total if stage_total else 0
+                }
+                for stage, seconds in sorted(self.stages.items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))
+            }
+        }
+
+    def close(self):
+        """
+        Prints the summary report and writes it as the last JSON line.
+        """
+        summary = self.summary()
+        self.write(summary)
+
+        peaks = ''
+        if summary['peak_rss'] is not None:
+            peaks = f', peak RSS {summary["peak_rss"] / 2**20:.0f} MiB'
+            if summary['peak_worker_rss']:
+                peaks += f' (largest worker {summary["peak_worker_rss"] / 2**20:.0f} MiB)'
+
+        print(
+            f'{summary["images"]} images in {format_duration(summary["wall_time"])}, '
+            f'{summary["images_per_second"]:.2f} images/s{peaks}'
+        )
+
+        for stage, values in summary['stages'].items():
+            print(f'  {stage:<10} {values["total"]:10.2f}s total {values["mean"]:8.3f}s/image {values["share"]:6.1%}')
+
+        if self.file:
+            self.file.close()
@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+from typing import Optional
+
+@dataclass
+class SegmentOptions:
+    """
+    Per-image segmentation settings
+    """
+    # 'crops' runs SAM on every crop, 'prompt' encodes the image once and only decodes the prompts
+    mode: str = 'crops'
+    # Tiles per side encoded by SAM in prompt mode (1 = full image)
+    prompt_tiles: int = 1
+    # Number of point prompts sent to the mask decoder at once
+    prompt_batch_size: int = 64
+    # 'image' fits k-means on every image, 'batch' fits it once per folder and labels pixels through a lookup table
+    kmeans: str = 'image'
+    # Images per folder and pixels sampled to fit the k-means centers in batch mode
+    kmeans_sample_images: int = 8
+    kmeans_sample_size: int = 100000
+    # Masks overlapping by at least this fraction of the smallest one are merged into one instance
+    instance_overlap: float = 0.8
+    # Crop tiling: a 5x5 grid by default, or tiles of tile_size pixels, or sized from tile_memory bytes
+    tile_size: Optional[int] = None
+    tile_memory: Optional[int] = None
+    tile_overlap: int = 10
+    # Diagnostic figures: 'none', 'sample' (figures_sample evenly spaced images) or 'all'
+    figures: str = 'all'
+    figures_sample: int = 10
+    # Threads rendering the figures in the background
+    figure_workers: int = 2
+    # COCO segmentation format: 'polygon' contours or compressed 'rle' masks (keeps holes)
+    segmentation: str = 'polygon'
@@ -0,0 +1,53 @@
+from pathlib import Path
+import numpy as np
+from ultralytics.models.sam import Predictor, SAM2Predictor
+
+from soilfauna.image.tiling import grid_tiles
+from soilfauna.segment.instances import result_instances
+
+
+class PromptPredictor:
+    """
+    SAM wrapper running the image encoder once per image (or per large tile)
+    and only the mask decoder for the point prompts, in batches.
+    """
+    def __init__(self, model, tiles=1, batch_size=64, overlap=64):
+        predictor = SAM2Predictor if 'sam2' in Path(model).stem else Predictor
+
+        self.predictor = predictor(overrides=dict(
+            conf=0.25,
+            task='segment',
+            mode='predict',
+            imgsz=1024,
+            model=model,
+            save=False,
+            verbose=False
+        ))
+        self.tiles = tiles
+        self.batch_size = batch_size
+        self.overlap = overlap
+
+    def predict(self, image, points):
+        """
+        Yields an Instance, in image coordinates, for every mask found from the points
+        given in image coordinates.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        height, width = image.shape[:2]
+
+        for tile in grid_tiles(height, width, self.tiles, self.tiles, self.overlap):
+            tile_points = tile.to_tile(points[tile.owns(points)])
+
+            if not len(tile_points):
+                continue
+
+            self.predictor.set_image(np.ascontiguousarray(tile.view(image)))
+
+            for start in range(0, len(tile_points), self.batch_size):
+                batch = tile_points[start:start + self.batch_size]
+                results = self.predictor(points=batch, labels=np.ones(len(batch), dtype=np.int32))
+
+                for result in results:
+                    yield from result_instances(result, (tile.x1, tile.y1), (height, width))
+
+            self.predictor.reset_image()
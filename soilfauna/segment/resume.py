@@ -0,0 +1,148 @@
+from dataclasses import asdict
+from pathlib import Path
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+
+SHARD_SUFFIX = '-annotations.shard.jsonl'
+
+def run_hash(model, options):
+    """
+    Hash of the parameters changing the annotations of a run. Figure settings are left out.
+    """
+    params = {key: value for key, value in asdict(options).items() if not key.startswith('figure')}
+    params['model'] = Path(model).name
+
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+class RunManifest:
+    """
+    SQLite record of the images completed by a segmentation run and of the parameters hash.
+    Opening it with another hash starts the run over.
+    """
+    def __init__(self, path, params_hash):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.create_tables()
+
+        self.restarted = self.params_hash() not in (None, params_hash)
+
+        with self.connection:
+            if self.restarted:
+                self.connection.execute('DELETE FROM images')
+            self.connection.execute("INSERT OR REPLACE INTO run (key, value) VALUES ('params', ?)", (params_hash,))
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS run (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS images (
+                    path TEXT PRIMARY KEY,
+                    folder TEXT NOT NULL
+                );
+            ''')
+
+    def params_hash(self):
+        row = self.connection.execute("SELECT value FROM run WHERE key = 'params'").fetchone()
+        return row and row[0]
+
+    def done(self):
+        return {path for (path,) in self.connection.execute('SELECT path FROM images')}
+
+    def mark_done(self, path, folder):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO images (path, folder) VALUES (?, ?)', (path, folder))
+
+    def close(self):
+        self.connection.close()
+
+class AnnotationShards:
+    """
+    Append-only JSON lines files, one per image folder, holding the annotations of each completed image.
+    A line is synced to disk before its image is marked done, lines of images never marked done are ignored.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def shard_path(self, folder):
+        return os.path.join(self.directory, f'{folder}{SHARD_SUFFIX}')
+
+    def write(self, path, folder, file_name, shape, annotations, segmentation='polygon'):
+        if segmentation == 'rle':
+            annotations = [list(annotation) for annotation in annotations]
+        else:
+            annotations = [contour.reshape(-1, 2).tolist() for contour in annotations]
+
+        record = {
+            'path': path,
+            'file_name': file_name,
+            'shape': list(shape[:2]),
+            'annotations': annotations
+        }
+
+        if folder not in self.files:
+            self.files[folder] = self.open(folder)
+
+        file = self.files[folder]
+        file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+    def open(self, folder):
+        path = self.shard_path(folder)
+        file = open(path, 'a', encoding='utf-8')
+
+        # A run killed while writing leaves a partial last line, the next record starts on its own line
+        if os.path.getsize(path):
+            with open(path, 'rb') as shard:
+                shard.seek(-1, os.SEEK_END)
+                if shard.read() != b'\n':
+                    file.write('\n')
+
+        return file
+
+    def read(self, folder, done, segmentation='polygon'):
+        """
+        Yields (file_name, shape, annotations) for the images of a folder marked done, once each, in shard order.
+        """
+        seen = set()
+
+        with open(self.shard_path(folder), 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partial line of a killed run
+                    continue
+
+                if record['path'] not in done or record['path'] in seen:
+                    continue
+                seen.add(record['path'])
+
+                if segmentation == 'rle':
+                    annotations = [tuple(annotation) for annotation in record['annotations']]
+                else:
+                    annotations = [np.asarray(points, dtype=np.int32).reshape(-1, 1, 2) for points in record['annotations']]
+
+                yield record['file_name'], tuple(record['shape']), annotations
+
+    def folders(self):
+        return sorted(
+            name[:-len(SHARD_SUFFIX)] for name in os.listdir(self.directory) if name.endswith(SHARD_SUFFIX)
+        )
+
+    def clear(self):
+        self.close()
+        for folder in self.folders():
+            os.remove(self.shard_path(folder))
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
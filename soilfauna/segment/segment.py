@@ -1,99 +1,361 @@
 import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+from pathlib import Path
 import cv2
-import matplotlib.pyplot as plt
-import numpy as np
 from ultralytics import SAM
 
 from soilfauna.dataset import Dataset
-from soilfauna.export import CocoGenerator
-from soilfauna.image.process import convert_to_binary
+from soilfauna.export import CocoGenerator, CocoStreamWriter
+from soilfauna.image.process import KMeansLookup, find_prompt_points, prompt_boxes
+from soilfauna.image.tiling import DEFAULT_TILE_MEMORY, choose_tile_size, grid_tiles, iter_tiles
+from soilfauna.segment.figures import FigureWriter, figure_selection
+from soilfauna.segment.instances import instance_map, merge_clipped, merge_duplicates, result_instances
+from soilfauna.segment.metrics import RunMetrics, StageTimer, peak_rss
+from soilfauna.segment.options import SegmentOptions
+from soilfauna.segment.predictor import PromptPredictor
+from soilfauna.segment.resume import AnnotationShards, RunManifest, run_hash
 
+# SAM model and figure writer created once per worker process by _init_worker
+_worker_sam = None
+_worker_figures = None
 
-def get_coco_generator(generators, key):
+
+def get_coco_generator(generators, key, factory=None):
+    """
+    Returns the (generator, category id) of a folder. factory builds the generator from
+    the folder name, a CocoGenerator is used by default.
+    """
     if key in generators:
         return generators[key]
     else:
-        generator = CocoGenerator()
+        generator = factory(key) if factory else CocoGenerator()
         category_id = generator.add_category()
         generators[key] = (generator, category_id)
         return generators[key]
 
-def segment(model, dataset_path, metadata_path, crop_output, annotations_output, processed_output):
-    dataset = Dataset(dataset_path, metadata_path, metadata_prefix='_no_bkgd')
-    sam = SAM(model)
+def export_annotations(generators, data, shape, annotations, factory=None, segmentation='polygon'):
+    """
+    Adds an image and its annotations to the generator of the image's folder.
+    annotations are contours, or (rle, bbox, area) with the 'rle' segmentation.
+    """
+    export_image(generators, data.image_path.parent.stem, data.image_path.name, shape, annotations, factory, segmentation)
 
-    coco_generators = {}
+def export_image(generators, folder, file_name, shape, annotations, factory=None, segmentation='polygon'):
+    coco_annotation, default_category_id = get_coco_generator(generators, folder, factory)
+    image_id = coco_annotation.add_image(shape, file_name)
+
+    if segmentation == 'rle':
+        for rle, bbox, area in annotations:
+            coco_annotation.add_rle_annotation(image_id, default_category_id, rle, bbox, area)
+        return
+
+    coco_annotation.add_annotations_batch(
+        image_id=image_id,
+        category_id=default_category_id,
+        contours=annotations
+    )
+
+def fit_kmeans(dataset, options):
+    """
+    Fits one KMeansLookup per image folder on a few evenly spaced images of the folder.
+    Returns an empty dict unless options.kmeans is 'batch'.
+    """
+    if options.kmeans != 'batch':
+        return {}
+
+    folders = {}
 
     for data in dataset:
-        data.load()
-        image = data.image
-
-        coco_annotation, default_category_id = get_coco_generator(coco_generators, data.image_path.parent.stem)
-        image_id = coco_annotation.add_image(image, data.image_path.name)
-
-        print(f'Image: {data.image_path.stem}')
-        image_masks = np.zeros((data.full_height, data.full_width), dtype=np.uint8)
-        i = 1
-        
-        crops = data.get_crops()
-        print(str(data))
-
-        for crop, bbox_centers, coords, raw in crops:
-            print(f'Crop analysis: {i}/{len(crops)}')
-            binary = convert_to_binary(crop)
-            inv = cv2.bitwise_not(binary)
-            gray = cv2.cvtColor(inv, cv2.COLOR_BGR2GRAY)
-
-            dist = cv2.distanceTransform(gray, cv2.DIST_L2, 5)
-            _, dist_thresh = cv2.threshold(dist, 0.2*dist.max(), 1, cv2.THRESH_BINARY)
-            
-            contours, _ = cv2.findContours(dist_thresh.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            centers = []
-
-            for cnt in contours:
-                M = cv2.moments(cnt)
-                if M["m00"] > 0:
-                    cx = int(M["m10"]/M["m00"])
-                    cy = int(M["m01"]/M["m00"])
-                    cv2.circle(crop, (cx, cy), 0, (255, 0, 0), 3)
-                    centers.append([cx, cy])
-
-            if centers:
-                results = sam.predict(raw, points=centers)
-                for result in results:
-                    for mask in result.masks.data:
-                        region_mask = mask.cpu().numpy().astype(np.uint8)
-                        image_masks[coords[1]:coords[3], coords[0]:coords[2]] = np.maximum(image_masks[coords[1]:coords[3], coords[0]:coords[2]], region_mask)
-            
-            fig, (ax1, ax2) = plt.subplots(1, 2)
-            ax1.imshow(crop)
-            ax2.imshow(dist_thresh, cmap='gray')
-
-            plt.savefig(f'{crop_output}/c{i}_{data.image_path.stem}.png', dpi=500)
-            plt.close()
-            i += 1
-
-            print('==============================\n')
-
-        mask_uint8 = image_masks.astype(np.uint8) * 255
-        mask_contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
-
-        for mask_contour in mask_contours:
-            coco_annotation.add_annotations(
-                image_id=image_id,
-                category_id=default_category_id,
-                contour=mask_contour
-            )
-
-        cv2.drawContours(data.image, mask_contours, -1, (0,255,0), 3)
-
-        fig, (ax1, ax2) = plt.subplots(1, 2)
-        ax1.imshow(data.image)
-        ax2.imshow(image_masks, cmap='binary')
-        plt.savefig(f'{processed_output}/fig_{data.image_path.stem}.png', dpi=400)
-        plt.close()
+        folders.setdefault(data.image_path.parent.stem, []).append(data)
+
+    lookups = {}
+
+    for name, images in folders.items():
+        step = max(1, len(images) // options.kmeans_sample_images)
+        samples = [image.read_image(image.image_path) for image in images[::step][:options.kmeans_sample_images]]
+        lookups[name] = KMeansLookup.fit(samples, sample_size=options.kmeans_sample_size)
+
+    return lookups
+
+def load_model(model, options):
+    """
+    Loads SAM for the segmentation mode in options.
+    """
+    if options.mode == 'prompt':
+        return PromptPredictor(model, tiles=options.prompt_tiles, batch_size=options.prompt_batch_size)
+
+    return SAM(model)
+
+def crop_tiles(data, options):
+    """
+    Returns the tiles of the image analysed as crops.
+    """
+    height, width = data.full_height, data.full_width
+
+    if options.tile_size or options.tile_memory:
+        tile_size = options.tile_size or choose_tile_size(height, width, options.tile_memory or DEFAULT_TILE_MEMORY, options.tile_overlap)
+        return list(iter_tiles(height, width, tile_size, options.tile_overlap))
+
+    return list(grid_tiles(height, width, 5, 5, options.tile_overlap))
+
+def segment_image(sam, data, options, kmeans=None, figures=None, timer=None):
+    """
+    Segments a single image. Returns the image shape and the annotations of the objects found,
+    one per instance: contours, or (rle, bbox, area) with the 'rle' segmentation.
+    figures is an optional FigureWriter receiving the diagnostic figures of the image.
+    timer is an optional StageTimer receiving the time spent in each stage.
+    """
+    timer = timer or StageTimer()
+
+    data.load(kmeans)
+    timer.update(data.timings)
+
+    instances = []
+
+    with timer.stage('prompts'):
+        tiles = crop_tiles(data, options)
+
+        # Prompts are found once on the whole image, then split between the tiles owning them
+        points, dist_thresh = find_prompt_points(data.foreground, tiles)
+        size = (data.full_height, data.full_width)
+
+        if options.mode != 'prompt' and len(points):
+            boxes = prompt_boxes(data.foreground, points, options.tile_overlap)
+
+    for i, tile in enumerate(tiles, start=1):
+        owned = tile.owns(points)
+        centers = tile.to_tile(points[owned]).tolist()
+
+        if centers and options.mode != 'prompt':
+            # SAM sees the whole object of each prompt, not only the part inside the tile
+            view = tile.grow(boxes[owned], *size)
+
+            with timer.stage('sam'):
+                for result in sam.predict(view.view(data.raw_image), points=view.to_tile(points[owned]).tolist()):
+                    instances.extend(result_instances(result, (view.x1, view.y1), size))
+
+        if figures:
+            with timer.stage('figures'):
+                figures.crop(data.image_path.stem, i, tile.view(data.image), centers, tile.view(dist_thresh))
+
+    if len(points) and options.mode == 'prompt':
+        # The image is encoded once, every prompt only goes through the mask decoder
+        with timer.stage('sam'):
+            instances.extend(sam.predict(data.raw_image, points))
+
+    with timer.stage('contours'):
+        # Objects larger than a view are still cut at its border, their pieces are joined
+        instances = merge_clipped(instances)
+        # Prompts falling in the same object give near-identical masks
+        instances = merge_duplicates(instances, options.instance_overlap)
+        contours = []
+
+        if options.segmentation == 'polygon' or figures:
+            contours = [contour for contour in (instance.contour() for instance in instances) if contour is not None]
+
+        if options.segmentation == 'rle':
+            annotations = [instance.rle(size) for instance in instances]
+        else:
+            annotations = contours
+
+    if figures:
+        with timer.stage('figures'):
+            figures.image(data.image_path.stem, data.image, instance_map(instances, data.full_height, data.full_width), contours)
+
+    return data.image.shape, annotations
+
+def image_key(data, dataset_path):
+    """
+    Path of an image relative to the dataset, identifying it between runs.
+    """
+    return Path(os.path.relpath(data.image_path, dataset_path)).as_posix()
+
+def create_figure_writer(crop_output, processed_output, options):
+    if options.figures == 'none':
+        return None
+
+    return FigureWriter(crop_output, processed_output, workers=options.figure_workers)
+
+def set_threads(torch_threads=None, opencv_threads=None):
+    """
+    Limits the threads of torch and OpenCV in the current process, None keeps their default.
+    """
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+
+    if opencv_threads:
+        cv2.setNumThreads(opencv_threads)
+
+def _init_worker(model, torch_threads, opencv_threads, options, crop_output, processed_output):
+    global _worker_sam, _worker_figures
+
+    set_threads(torch_threads, opencv_threads)
+
+    _worker_sam = load_model(model, options)
+    _worker_figures = create_figure_writer(crop_output, processed_output, options)
+
+    if _worker_figures:
+        # Workers exit without joining threads, pending figures are flushed by this finalizer
+        Finalize(_worker_figures, _worker_figures.close, exitpriority=10)
+
+def _segment_worker(data, kmeans, options, figures):
+    """
+    Returns the image shape, its annotations, its stage timings and the peak RSS of the worker.
+    """
+    timer = StageTimer()
+
+    try:
+        return (*segment_image(_worker_sam, data, options, kmeans, _worker_figures if figures else None, timer), timer.stages, peak_rss())
+    finally:
+        data.release()
+
+def segment(model, dataset_path, metadata_path, crop_output, annotations_output, processed_output, workers=1, options=None, manifest_path=None, max_resident=2, stream_export=False, resume=False, metrics_path=None, torch_threads=None, opencv_threads=None, shard=None, deduplicate=None):
+    """
+    Segments every image of the dataset and writes one COCO file per image folder.
+
+    With workers > 1, images are spread over a process pool where each worker loads SAM once.
+    Results are collected in dataset order, so image and annotation ids do not depend on
+    which worker finished first.
+
+    options is a SegmentOptions, e.g. SegmentOptions(mode='prompt') to encode each image only once.
+    manifest_path is an optional SQLite file indexing the dataset between runs (see DatasetManifest).
+    max_resident bounds the number of images held in memory at once, or with workers > 1
+    the number of images queued per worker.
+    With stream_export, annotations are written to disk as compact JSON while images are
+    processed instead of being kept in memory (see CocoStreamWriter).
+    With resume, the annotations of every image are appended to shards in annotations_output as soon
+    as it is done, and a rerun with the same model and options skips the images already done
+    (see RunManifest). The shards are compacted into the COCO files at the end.
+    Progress, stage timings and memory are reported for every image, and also written as
+    JSON lines to metrics_path when given (see RunMetrics).
+    torch_threads and opencv_threads limit the threads of each process. With workers > 1,
+    they default to the cores split between the workers.
+    shard is an optional (index, count) to segment only one shard of the dataset, e.g. one per
+    machine (see Dataset.in_shard). Shard outputs are combined with merge_coco.
+    deduplicate is None, 'content' or 'perceptual' to segment images found several times in the
+    dataset once, their copies getting the same annotations (see find_duplicates).
+    """
+    options = options or SegmentOptions()
+    dataset = Dataset(dataset_path, metadata_path, metadata_prefix='_no_bkgd', manifest_path=manifest_path, shard=shard, deduplicate=deduplicate)
+    with_figures = {dataset[index].image_path for index in figure_selection(len(dataset.data), options.figures, options.figures_sample)}
+
+    coco_generators = {}
+    factory = None
+
+    if stream_export:
+        def factory(name):
+            return CocoStreamWriter(f'{annotations_output}/{name}-annotations.json')
+
+    run = None
+    shards = None
+
+    if resume:
+        run = RunManifest(f'{annotations_output}/run.sqlite', run_hash(model, options))
+        shards = AnnotationShards(annotations_output)
+
+        if run.restarted:
+            print('Segmentation parameters changed, starting the run over')
+            shards.clear()
+
+        done = run.done()
+        dataset.data = [
+            data for data in dataset
+            if any(image_key(image, dataset_path) not in done for image in [data, *dataset.duplicates.get(data, [])])
+        ]
+        print(f'Resuming run: {len(done)} images done, {len(dataset.data)} left')
+
+    if dataset.duplicates:
+        print(f'{sum(len(copies) for copies in dataset.duplicates.values())} duplicate images, segmented once')
+
+    metrics = RunMetrics(len(dataset.data), metrics_path)
+
+    def export(data, shape, annotations, stages, worker_rss=None):
+        start = time.perf_counter()
+        export_result(data, shape, annotations)
+
+        for copy in dataset.duplicates.get(data, []):
+            export_result(copy, shape, annotations)
+        metrics.record(data.image_path.name, {**stages, 'export': time.perf_counter() - start}, worker_rss)
+
+    def export_result(data, shape, annotations):
+        if run:
+            folder = data.image_path.parent.stem
+            shards.write(image_key(data, dataset_path), folder, data.image_path.name, shape, annotations, options.segmentation)
+            run.mark_done(image_key(data, dataset_path), folder)
+        else:
+            export_annotations(coco_generators, data, shape, annotations, factory, options.segmentation)
+
+    lookups = fit_kmeans(dataset, options)
+
+    def folder_kmeans(data):
+        return lookups.get(data.image_path.parent.stem)
+
+    try:
+        if workers > 1:
+            # Split the cores between workers instead of letting each one grab all of them
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            initargs = (model, torch_threads or threads, opencv_threads or threads, options, crop_output, processed_output)
+
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+                # Bounded submission window, results are exported in dataset order as soon as possible
+                pending = deque()
+
+                for data in dataset:
+                    future = executor.submit(_segment_worker, data, folder_kmeans(data), options, data.image_path in with_figures)
+                    pending.append((data, future))
+
+                    if len(pending) >= workers * max_resident:
+                        data, future = pending.popleft()
+                        export(data, *future.result())
+
+                while pending:
+                    data, future = pending.popleft()
+                    export(data, *future.result())
+        else:
+            set_threads(torch_threads, opencv_threads)
+            sam = load_model(model, options)
+            figures = create_figure_writer(crop_output, processed_output, options)
+
+            try:
+                images = dataset.stream(max_resident, load=lambda data: data.load(folder_kmeans(data)))
+
+                for data in images:
+                    timer = StageTimer()
+                    shape, annotations = segment_image(sam, data, options, figures=figures if data.image_path in with_figures else None, timer=timer)
+                    export(data, shape, annotations, timer.stages)
+            finally:
+                if figures:
+                    figures.close()
+
+        if run:
+            # Shards hold the images in dataset order, as they are exported in order
+            done = run.done()
+
+            for folder in shards.folders():
+                for file_name, shape, annotations in shards.read(folder, done, options.segmentation):
+                    export_image(coco_generators, folder, file_name, shape, annotations, factory, options.segmentation)
+    except BaseException:
+        # A failed run leaves no part files behind
+        for generator, _ in coco_generators.values():
+            if stream_export:
+                generator.discard()
+        raise
+    finally:
+        metrics.close()
+
+        if run:
+            shards.close()
+            run.close()
 
     for name, (generator, _) in coco_generators.items():
+        if stream_export:
+            generator.close()
+            continue
+
         with open(f'{annotations_output}/{name}-annotations.json', 'w', encoding='utf-8') as file:
-            json.dump(generator.generate(), file, ensure_ascii=False, indent=4)
\ No newline at end of file
+            json.dump(generator.generate(), file, ensure_ascii=False, indent=4)
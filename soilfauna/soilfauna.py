@@ -1,14 +1,168 @@
-from soilfauna.segment import segment
+import argparse
+from dataclasses import fields
 from pathlib import Path
+import os
+import yaml
+from soilfauna.segment import segment, SegmentOptions
 
 ROOT_DIR = Path(__file__).parent.parent.as_posix()
 
-model = ROOT_DIR + '/models/sam2_b.pt'
-crop_output_dir = ROOT_DIR + '/out/crops'
-annotations_output_dir = ROOT_DIR + '/out/annotations'
-image_output_dir = ROOT_DIR + '/out/full'
-dataset_path = '/Users/robin/Pictures/soil-fauna-ai/sample'
-metadata_path = '/Users/robin/Pictures/soil-fauna-ai/BBox_centers'
+DEFAULTS = {
+    'model': ROOT_DIR + '/models/sam2_b.pt',
+    'output': ROOT_DIR + '/out',
+    'workers': max(1, (os.cpu_count() or 1) // 4),
+    'max_resident': 2,
+    'stream_export': False,
+    'resume': False
+}
+
+parser = argparse.ArgumentParser(
+    description='Segments every image of a dataset with SAM and writes one COCO file per image folder. '
+                'Settings are read from the config file, flags override them.'
+)
+
+parser.add_argument('-c', '--config',
+                    help='YAML (or JSON) file of settings, keys are the long flag names with underscores '
+                         'and any SegmentOptions field')
+
+parser.add_argument('-i', '--input',
+                    help='Dataset folder, searched recursively for .jpg images')
+
+parser.add_argument('--metadata',
+                    help='Folder of the images metadata files')
+
+parser.add_argument('-o', '--output',
+                    help='Output folder, holding annotations/, crops/ and full/ unless set separately')
+
+parser.add_argument('--annotations_output')
+parser.add_argument('--crops_output')
+parser.add_argument('--figures_output')
+
+parser.add_argument('-m', '--model',
+                    help='SAM checkpoint')
+
+parser.add_argument('-w', '--workers',
+                    type=int,
+                    help='Worker processes, each loading the model once')
+
+parser.add_argument('--max_resident',
+                    type=int,
+                    help='Images held in memory at once, or queued per worker')
+
+parser.add_argument('--torch_threads',
+                    type=int,
+                    help='Torch threads per process, defaults to the cores split between the workers')
+
+parser.add_argument('--opencv_threads',
+                    type=int,
+                    help='OpenCV threads per process, defaults to the cores split between the workers')
+
+parser.add_argument('--mode',
+                    choices=['crops', 'prompt'])
+
+parser.add_argument('--tile_size',
+                    type=int,
+                    help='Crop size in pixels, instead of a 5x5 grid')
+
+parser.add_argument('--tile_memory',
+                    type=int,
+                    help='Memory budget of a crop in bytes, used to choose the crop size')
+
+parser.add_argument('--figures',
+                    choices=['none', 'sample', 'all'],
+                    help='Diagnostic figures to write')
+
+parser.add_argument('--segmentation',
+                    choices=['polygon', 'rle'],
+                    help='COCO segmentation format')
+
+parser.add_argument('--manifest',
+                    help='SQLite file indexing the dataset between runs')
+
+parser.add_argument('--metrics',
+                    help='JSON lines file receiving the timings of every image')
+
+parser.add_argument('--shard',
+                    help='Only segment shard i of N, given as i/N (0 <= i < N)')
+
+parser.add_argument('--deduplicate',
+                    choices=['content', 'perceptual'],
+                    help='Segment images found several times once: identical files, or also re-encoded copies')
+
+parser.add_argument('--stream_export',
+                    action='store_true',
+                    default=None,
+                    help='Write annotations to disk while images are processed')
+
+parser.add_argument('--resume',
+                    action='store_true',
+                    default=None,
+                    help='Skip the images done by a previous run with the same settings')
+
+
+def load_config(path):
+    if not path:
+        return {}
+
+    with open(path, 'r', encoding='utf-8') as file:
+        return yaml.safe_load(file) or {}
+
+def settings_from(args):
+    """
+    Merges the defaults, the config file and the flags given, in this order of precedence.
+    """
+    flags = {key: value for key, value in vars(args).items() if value is not None and key != 'config'}
+    settings = {**DEFAULTS, **load_config(args.config), **flags}
+
+    unknown = set(settings) - {action.dest for action in parser._actions} - {field.name for field in fields(SegmentOptions)}
+    if unknown:
+        parser.error(f'unknown settings in the config file: {", ".join(sorted(unknown))}')
+
+    if not settings.get('input'):
+        parser.error('the dataset folder is required, with --input or in the config file')
+
+    if settings.get('shard'):
+        index, _, count = str(settings['shard']).partition('/')
+        if not (index.isdigit() and count.isdigit()):
+            parser.error(f'shard must be given as i/N, got {settings["shard"]}')
+        settings['shard'] = (int(index), int(count))
+
+    return settings
+
+def run(settings):
+    output = settings['output']
+
+    annotations_output = settings.get('annotations_output') or f'{output}/annotations'
+    crops_output = settings.get('crops_output') or f'{output}/crops'
+    figures_output = settings.get('figures_output') or f'{output}/full'
+
+    options = SegmentOptions(**{field.name: settings[field.name] for field in fields(SegmentOptions) if field.name in settings})
+
+    os.makedirs(annotations_output, exist_ok=True)
+
+    if options.figures != 'none':
+        os.makedirs(crops_output, exist_ok=True)
+        os.makedirs(figures_output, exist_ok=True)
+
+    segment(
+        settings['model'],
+        settings['input'],
+        settings.get('metadata'),
+        crops_output,
+        annotations_output,
+        figures_output,
+        workers=settings['workers'],
+        options=options,
+        manifest_path=settings.get('manifest'),
+        max_resident=settings['max_resident'],
+        stream_export=settings['stream_export'],
+        resume=settings['resume'],
+        metrics_path=settings.get('metrics'),
+        torch_threads=settings.get('torch_threads'),
+        opencv_threads=settings.get('opencv_threads'),
+        shard=settings.get('shard'),
+        deduplicate=settings.get('deduplicate')
+    )
 
 if __name__ == '__main__':
-    segment(model, dataset_path, None, crop_output_dir, annotations_output_dir, image_output_dir)
\ No newline at end of file
+    run(settings_from(parser.parse_args()))
@@ -0,0 +1,104 @@
+from pathlib import Path
+import cv2
+import numpy as np
+
+from soilfauna.dataset import ImageData
+from soilfauna.segment import SegmentOptions
+from soilfauna.segment.instances import Instance, merge_clipped
+from soilfauna.segment.segment import segment_image
+
+
+class Masks:
+    """
+    Stands in for the tensor of the masks of an ultralytics result.
+    """
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+
+    def __iter__(self):
+        return (Masks(mask) for mask in self.array)
+
+    def __getitem__(self, index):
+        return Masks(self.array[index])
+
+    def any(self, axis):
+        return Masks(self.array.any(axis))
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class FloodFillSAM:
+    """
+    Stands in for SAM: the mask of a point is the dark region holding it, within the given view.
+    """
+    def predict(self, image, points):
+        dark = (image[:, :, 0] < 128).astype(np.uint8)
+        _, labels = cv2.connectedComponents(dark, connectivity=8)
+        masks = np.stack([labels == labels[y, x] for x, y in points])
+
+        return [type('Result', (), {'masks': type('Masks', (), {'data': Masks(masks)})})()]
+
+
+def loaded_image(image):
+    data = ImageData(Path('seam.jpg'))
+    data.raw_image = image
+    data.image = image
+    data.foreground = image[:, :, 0] < 128
+    data.full_height, data.full_width = image.shape[:2]
+    data.loaded = True
+
+    return data
+
+
+def segment(image, **options):
+    data = loaded_image(image)
+    _, contours = segment_image(FloodFillSAM(), data, SegmentOptions(figures='none', **options))
+
+    return [cv2.boundingRect(contour) for contour in contours]
+
+
+def test_object_across_a_seam_is_whole():
+    image = np.full((100, 200, 3), 255, dtype=np.uint8)
+    # Spans x = 40..160, across the seam of the two 100 px tiles at x = 100
+    cv2.ellipse(image, (100, 50), (60, 20), 0, 0, 360, (0, 0, 0), -1)
+
+    boxes = segment(image, tile_size=100)
+
+    assert len(boxes) == 1
+    assert boxes[0][0] == 40
+    assert boxes[0][2] == 121
+
+
+def test_long_object_is_whole():
+    image = np.full((40, 400, 3), 255, dtype=np.uint8)
+    # Crosses every seam of the 50 px tiles
+    cv2.rectangle(image, (5, 10), (394, 30), (0, 0, 0), -1)
+
+    boxes = segment(image, tile_size=50)
+
+    assert boxes == [(5, 10, 390, 21)]
+
+
+def test_pieces_cut_at_a_seam_are_joined():
+    left = Instance(40, 30, np.ones((40, 61), dtype=bool), clipped=True)
+    right = Instance(101, 30, np.ones((40, 60), dtype=bool), clipped=True)
+    apart = Instance(170, 30, np.ones((40, 20), dtype=bool))
+
+    merged = sorted(merge_clipped([left, right, apart]), key=lambda instance: instance.x)
+
+    assert [instance.box for instance in merged] == [(40, 30, 161, 70), (170, 30, 190, 70)]
+
+
+def test_touching_tiles_keep_separate_objects():
+    image = np.full((100, 200, 3), 255, dtype=np.uint8)
+    cv2.circle(image, (50, 50), 20, (0, 0, 0), -1)
+    cv2.circle(image, (150, 50), 20, (0, 0, 0), -1)
+
+    boxes = sorted(segment(image, tile_size=100))
+
+    assert [box[0] for box in boxes] == [30, 130]